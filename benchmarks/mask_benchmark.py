@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+""" Micro-benchmark of the lookup table mask functions against the previous
+    masked-array implementation
+
+    usage: python benchmarks/mask_benchmark.py [--size 10980] [--repeat 3]
+"""
+import os
+import sys
+import timeit
+from argparse import ArgumentParser
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, 'src'))
+import raster_mod as rm
+
+
+# previous implementations (masked array per code / per band)
+def binary_mask_masked(scl, pixel_values):
+    mask = np.zeros(scl.shape)
+    for pixel_value in pixel_values:
+        mask = np.ma.masked_where(scl == pixel_value, mask).filled(1)
+    return(mask)
+
+
+def mask_array_masked(mask, array):
+    return(np.ma.masked_where(mask == 0, array).filled(0))
+
+
+def run(size, repeat):
+    scl = np.random.randint(0, 12, (size, size)).astype(np.uint8)
+    band = np.random.randint(0, 10000, (size, size)).astype(np.uint16)
+    codes = [4, 5, 6, 7]
+
+    mask = rm.binary_mask(scl, codes)
+    assert np.array_equal(mask, binary_mask_masked(scl, codes))
+    assert np.array_equal(rm.mask_array(mask, band.copy()), mask_array_masked(mask, band))
+
+    timings = [
+        ('binary_mask (masked array)', lambda: binary_mask_masked(scl, codes)),
+        ('binary_mask (lookup table)', lambda: rm.binary_mask(scl, codes)),
+        ('mask_array (masked array)', lambda: mask_array_masked(mask, band)),
+        ('mask_array (in place)', lambda: rm.mask_array(mask, band.copy())),
+    ]
+    print('grid: {0} x {0}, scl codes: {1}'.format(size, codes))
+    for name, func in timings:
+        best = min(timeit.repeat(func, number=1, repeat=repeat))
+        print('{:<30} {:>8.3f} s'.format(name, best))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="mask function micro-benchmark")
+    parser.add_argument("--size", type=int, dest='size', default=10980, help="grid width / height in pixels")
+    parser.add_argument("--repeat", type=int, dest='repeat', default=3, help="number of timed repeats")
+    args = parser.parse_args()
+    run(args.size, args.repeat)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+""" Benchmark of the ARD pipeline on synthetic Sentinel-2 SAFE products
+
+    Reports wall time, cpu time, peak RSS and bytes read / written for
+    ProcessTile.process_tile (per tile), build_mosaic, compute_average and each
+    spectral index function. Sen2Cor and Fmask are replaced by stubs when they are
+    not installed (or with --stub-tools).
+
+    Bytes read / written come from /proc/self/io (rchar / wchar), the gdal command
+    line tools started by the subprocess gdal backend only report block i/o, use
+    --gdal-backend api to account for all raster i/o. Per tile stage timings are
+    also written by process_tile (<tile>_timing.jsonl in the output directory).
+
+    usage: python benchmarks/pipeline_benchmark.py [--size small|full] [--dates 3] [--memory-budget MB] [--report report.json]
+"""
+import os
+import sys
+import json
+import stat
+import shutil
+import tempfile
+from argparse import ArgumentParser
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, 'src'))
+import ard
+import metrics
+import raster_mod as rm
+import config_reader as cfg
+from synthetic_safe import make_safe_series
+
+CONFIG = """
+tile-list:
+{tiles}
+mosaic-settings:
+  build-mosaic : false
+average-settings:
+  compute-average : false
+"""
+
+TILE_CONFIG = """  tile-{index}:
+    tile-name : {name}
+    ard-settings:
+      atm-corr : false
+      cloud-mask : true
+      stack : true
+      calibrate : false
+      clip : false
+      derived-index : true
+    cloud-mask-settings:
+      sen2cor-scl-codes : [4, 5]
+    output-image-settings:
+      bands : [B02, B03, B04, B08, B11]
+      vi : [ndvi, ndmi, bsi]
+      t-srs : False
+      resolution : 10
+      resampling-method : bilinear
+"""
+
+FMASK_STUB = """#!{python}
+# fmask stub - writes a 20 m 'clear' (1) mask on the grid of the SAFE product
+import sys, glob
+from osgeo import gdal
+out = sys.argv[sys.argv.index('-o') + 1]
+safe = sys.argv[sys.argv.index('--safedir') + 1]
+ref = gdal.Open(sorted(glob.glob(safe + '/GRANULE/*/IMG_DATA/*B11*.jp2') + glob.glob(safe + '/GRANULE/*/IMG_DATA/R20m/*B11*.jp2'))[0])
+dst = gdal.GetDriverByName('GTiff').Create(out, ref.RasterXSize, ref.RasterYSize, 1, gdal.GDT_Byte)
+dst.SetGeoTransform(ref.GetGeoTransform())
+dst.SetProjection(ref.GetProjection())
+dst.GetRasterBand(1).Fill(1)
+dst = None
+"""
+
+
+class Meter(object):
+    """ Measures a benchmark stage: with Meter(results, 'stage'): ... """
+
+    def __init__(self, results, name):
+        self.results = results
+        self.name = name
+
+    def __enter__(self):
+        metrics.reset_peak_rss()
+        self.before = metrics.snapshot()
+        return(self)
+
+    def __exit__(self, *exc):
+        result = {'stage': self.name}
+        result.update(metrics.measure(self.before, metrics.snapshot()))
+        self.results.append(result)
+        return(False)
+
+
+def install_stub_tools(bin_dir, force=False):
+    """ Puts no-op Sen2Cor / stub Fmask executables on the PATH if the real tools are missing """
+    os.makedirs(bin_dir)
+    stubs = {'L2A_Process': '#!/bin/sh\necho "L2A_Process stub: $@"\n',
+             'fmask_sentinel2Stacked.py': FMASK_STUB.format(python=sys.executable)}
+    for tool, script in stubs.items():
+        if force or shutil.which(tool) is None:
+            tool_path = os.path.join(bin_dir, tool)
+            with open(tool_path, 'w') as stream:
+                stream.write(script)
+            os.chmod(tool_path, os.stat(tool_path).st_mode | stat.S_IEXEC)
+            print('using stub: ', tool)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+
+def run(size, dates, root, stub_tools, windowed=False):
+    data_dir = os.path.join(root, 'data')
+    work_dir = os.path.join(root, 'work')
+    output_dir = os.path.join(root, 'output')
+    for directory in (work_dir, output_dir):
+        os.makedirs(directory)
+    install_stub_tools(os.path.join(root, 'bin'), stub_tools)
+
+    print('GENERATING {} SYNTHETIC SAFE PRODUCTS ({})'.format(dates, size))
+    names = make_safe_series(data_dir, dates, size)
+
+    config_file = os.path.join(root, 'config.yml')
+    with open(config_file, 'w') as stream:
+        stream.write(CONFIG.format(tiles=''.join(TILE_CONFIG.format(index=i + 1, name=name) for i, name in enumerate(names))))
+    ard_settings = cfg.ConfigReader(config_file, os.path.join(root, 'aoi.geojson'))
+
+    # module level directories / catalog set by the ard.py __main__ block
+    ard.work_dir = work_dir
+    ard.data_dir = data_dir
+    ard.catalog = ard.Catalog(data_dir)
+    ard.scheduler = ard.ToolScheduler(os.path.join(output_dir, 'logs'))
+
+    results = []
+    for image_config in ard_settings.image_list:
+        pg = ard.ProcessTile(image_config, windowed)
+        pg.output_dir = output_dir
+        with Meter(results, 'process_tile ' + image_config.tile_name[11:19]):
+            pg.process_tile(os.path.join(data_dir, image_config.tile_name))
+
+    mosaic_dir = os.path.join(output_dir, 'mosaic')
+    average_dir = os.path.join(output_dir, 'average')
+    os.makedirs(mosaic_dir)
+    os.makedirs(average_dir)
+    with Meter(results, 'build_mosaic'):
+        ard.build_mosaic(output_dir, names, mosaic_dir, 'nearest')
+    with Meter(results, 'compute_average'):
+        ard.compute_average(output_dir, names, average_dir)
+
+    # index functions on the first tile (10 m bands, 20 m B11 resampled to 10 m here)
+    pg = ard.ProcessTile(ard_settings.image_list[0])
+    safe_dir = os.path.join(data_dir, names[0])
+    bands = pg._subset_boa_bands(['B02', 'B03', 'B04', 'B08', 'B11'], pg._get_boa_band_pathes(pg._get_metadata_xml(safe_dir)))
+    bands['B11'] = rm.resample_image(bands['B11'], os.path.join(work_dir, 'bench_B11.tif'), pg.image_properties)
+    index_functions = [('normalized_diff', rm.normalized_diff, ['B08', 'B04']),
+                       ('vdvi', rm.vdvi, ['B02', 'B03', 'B04']),
+                       ('bare_soil', rm.bare_soil, ['B02', 'B04', 'B08', 'B11']),
+                       ('bsi_2', rm.bsi_2, ['B02', 'B04', 'B08', 'B11'])]
+    for name, function, function_bands in index_functions:
+        rm.clear_cache()
+        with Meter(results, name):
+            function(*[bands[band] for band in function_bands])
+    rm.clear_cache()
+    index_images = dict((index, os.path.join(work_dir, 'bench_' + index + '.tif')) for index in ['ndvi', 'ndmi', 'bsi'])
+    with Meter(results, 'derive_indices (ndvi, ndmi, bsi)'):
+        rm.derive_indices(['ndvi', 'ndmi', 'bsi'], bands, index_images, rm.get_band_meta(bands['B02']))
+    return(results)
+
+
+def print_report(results):
+    print('\n{:<36} {:>9} {:>9} {:>12} {:>10} {:>12}'.format('stage', 'wall s', 'cpu s', 'peak rss MB', 'read MB', 'written MB'))
+    for result in results:
+        print('{stage:<36} {wall_s:>9.2f} {cpu_s:>9.2f} {process_peak_rss_mb:>12.1f} {read_mb:>10.1f} {written_mb:>12.1f}'.format(**result))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="ARD pipeline benchmark on synthetic SAFE products")
+    parser.add_argument("--size", type=str, dest='size', default='small', help="small (1098 px), full (10980 px) or a pixel count")
+    parser.add_argument("--dates", type=int, dest='dates', default=3, help="number of synthetic products")
+    parser.add_argument("--gdal-backend", type=str, dest='gdal_backend', default='subprocess', choices=['subprocess', 'api'])
+    parser.add_argument("--memory-budget", type=int, dest='memory_budget', default=None,
+                        help="process the tiles in the windowed mode with this memory budget (MB)")
+    parser.add_argument("--stub-tools", action='store_true', dest='stub_tools', help="stub Sen2Cor / Fmask even if installed")
+    parser.add_argument("--keep", action='store_true', dest='keep', help="keep the benchmark directory")
+    parser.add_argument("--report", type=str, dest='report', default=None, help="write results to a json file")
+    args = parser.parse_args()
+
+    rm.set_gdal_backend(args.gdal_backend)
+    if args.memory_budget is not None:
+        rm.set_memory_budget(args.memory_budget)
+    root = tempfile.mkdtemp(prefix='s2-ard-bench-')
+    try:
+        results = run(int(args.size) if args.size.isdigit() else args.size, args.dates, root, args.stub_tools, args.memory_budget is not None)
+    finally:
+        if not args.keep:
+            shutil.rmtree(root)
+        else:
+            print('benchmark directory: ', root)
+
+    print_report(results)
+    if args.report:
+        with open(args.report, 'w') as stream:
+            json.dump(results, stream, indent=2)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+""" Synthetic Sentinel-2 SAFE product generator
+
+    Writes SAFE directories with an MTD_MSIL1C.xml / MTD_MSIL2A.xml whose
+    Product_Organisation/Granule_List/Granule/IMAGE_FILE entries are laid out like
+    ESA products, so ProcessTile._get_boa_band_pathes / _get_toa_band_pathes can
+    parse them, plus 10 / 20 / 60 m band rasters (random reflectances) and an SCL
+    raster.
+
+    usage: python benchmarks/synthetic_safe.py --out DATA_DIR [--size small|full] [--level L2A] [--dates 3]
+"""
+import os
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+import numpy as np
+from osgeo import gdal
+from osgeo import osr
+
+# 10 m grid width / height in pixels
+SIZES = {'small': 1098, 'full': 10980}
+
+# bands per resolution as delivered by ESA
+L1C_BANDS = {10: ['B02', 'B03', 'B04', 'B08'],
+             20: ['B05', 'B06', 'B07', 'B8A', 'B11', 'B12'],
+             60: ['B01', 'B09', 'B10']}
+L2A_BANDS = {10: ['B02', 'B03', 'B04', 'B08'],
+             20: ['B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B8A', 'B11', 'B12', 'SCL'],
+             60: ['B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B8A', 'B09', 'B11', 'B12', 'SCL']}
+
+# tile T56JMS - WGS 84 / UTM zone 56S
+EPSG = 32756
+ORIGIN = (300000, 7000000)
+
+
+def safe_name(level, sensing_time, tile_id='T56JMS'):
+    """ ESA style product name, i.e. S2A_MSIL2A_20200608T000251_N0214_R030_T56JMS_20200608T021427.SAFE """
+    sensing = sensing_time.strftime('%Y%m%dT%H%M%S')
+    return('_'.join(['S2A', 'MSI' + level, sensing, 'N0214', 'R030', tile_id, sensing]) + '.SAFE')
+
+
+def write_band(path, size, resolution, band, driver_name, seed):
+    rng = np.random.RandomState(seed)
+    if band == 'SCL':
+        # scene classification codes 0-11, mostly vegetation / not-vegetated
+        array = rng.choice(np.arange(12, dtype=np.uint8), (size, size), p=[0.04] + [0.04] * 3 + [0.3, 0.3] + [0.04] * 6).astype(np.uint8)
+        dtype = gdal.GDT_Byte
+    else:
+        array = rng.randint(1, 10000, (size, size)).astype(np.uint16)
+        dtype = gdal.GDT_UInt16
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+    mem = gdal.GetDriverByName('MEM').Create('', size, size, 1, dtype)
+    mem.SetGeoTransform([ORIGIN[0], resolution, 0, ORIGIN[1], 0, -resolution])
+    mem.SetProjection(srs.ExportToWkt())
+    mem.GetRasterBand(1).WriteArray(array)
+
+    driver = gdal.GetDriverByName(driver_name)
+    if driver is None:
+        # no JPEG2000 driver, GDAL opens the .jp2 file by its (GeoTIFF) content
+        driver = gdal.GetDriverByName('GTiff')
+    # the copy is not kept, it is written and closed once dropped
+    driver.CreateCopy(path, mem)
+    mem = None
+
+
+def make_safe(data_dir, sensing_time, size='small', level='L2A', driver_name='JP2OpenJPEG', seed=0):
+    """ Writes one synthetic SAFE product
+
+        Parameters
+        ----------
+        data_dir : str
+            directory the SAFE product is written to
+        sensing_time : datetime
+            sensing time (part of the product name)
+        size : str or int
+            'small', 'full' or the 10 m grid width / height in pixels (multiple of 6)
+        level : str
+            'L1C' or 'L2A'
+        driver_name : str
+            gdal driver used for the band rasters (JP2OpenJPEG or GTiff)
+        seed : int
+            random seed of the band values
+
+        Returns
+        -------
+        str
+            path to SAFE directory
+    """
+    size = SIZES.get(size, size)
+    name = safe_name(level, sensing_time)
+    safe_dir = os.path.join(data_dir, name)
+    granule = '_'.join([level, 'T56JMS', 'A025000', sensing_time.strftime('%Y%m%dT%H%M%S')])
+    prefix = '_'.join(['T56JMS', sensing_time.strftime('%Y%m%dT%H%M%S')])
+
+    image_files = []
+    if level == 'L2A':
+        for resolution, bands in sorted(L2A_BANDS.items()):
+            img_dir = '/'.join(['GRANULE', granule, 'IMG_DATA', 'R%dm' % resolution])
+            for band in bands:
+                image_files.append((img_dir + '/' + '_'.join([prefix, band, '%dm' % resolution]), resolution, band))
+    else:
+        img_dir = '/'.join(['GRANULE', granule, 'IMG_DATA'])
+        for resolution, bands in sorted(L1C_BANDS.items()):
+            for band in bands:
+                image_files.append((img_dir + '/' + '_'.join([prefix, band]), resolution, band))
+
+    for index, (image_file, resolution, band) in enumerate(image_files):
+        band_path = os.path.join(safe_dir, image_file + '.jp2')
+        if not os.path.exists(os.path.dirname(band_path)):
+            os.makedirs(os.path.dirname(band_path))
+        write_band(band_path, size * 10 // resolution, resolution, band, driver_name, seed * 100 + index)
+
+    # product metadata - only the elements read by ard.py
+    entries = '\n'.join(['              <IMAGE_FILE>{}</IMAGE_FILE>'.format(image_file) for image_file, _, _ in image_files])
+    metadata = '\n'.join([
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<n1:Level-{0}_User_Product xmlns:n1="https://psd-14.sentinel2.eo.esa.int/PSD/User_Product_Level-{0}.xsd">'.format(level[1:]),
+        '  <n1:General_Info>',
+        '    <Product_Info>',
+        '      <PRODUCT_TYPE>S2MSI{}</PRODUCT_TYPE>'.format(level[1:]),
+        '      <Product_Organisation>',
+        '        <Granule_List>',
+        '          <Granule granuleIdentifier="{}" imageFormat="JPEG2000">'.format(granule),
+        entries,
+        '          </Granule>',
+        '        </Granule_List>',
+        '      </Product_Organisation>',
+        '    </Product_Info>',
+        '  </n1:General_Info>',
+        '</n1:Level-{}_User_Product>'.format(level[1:]),
+        ''])
+    with open(os.path.join(safe_dir, 'MTD_MSI{}.xml'.format(level)), 'w') as stream:
+        stream.write(metadata)
+    return(safe_dir)
+
+
+def make_safe_series(data_dir, dates=3, size='small', level='L2A', driver_name='JP2OpenJPEG'):
+    """ Writes a time series of synthetic SAFE products (one every 5 days), returns their names """
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    start = datetime(2020, 6, 8, 0, 2, 51)
+    names = []
+    for i in range(dates):
+        safe_dir = make_safe(data_dir, start + timedelta(days=5 * i), size, level, driver_name, seed=i)
+        names.append(os.path.basename(safe_dir))
+    return(names)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="synthetic Sentinel-2 SAFE products")
+    parser.add_argument("--out", type=str, dest='out', help="output data directory", required=True)
+    parser.add_argument("--size", type=str, dest='size', default='small', help="small (1098 px), full (10980 px) or a pixel count")
+    parser.add_argument("--level", type=str, dest='level', default='L2A', choices=['L1C', 'L2A'], help="product level")
+    parser.add_argument("--dates", type=int, dest='dates', default=3, help="number of products (sensing dates)")
+    parser.add_argument("--driver", type=str, dest='driver', default='JP2OpenJPEG', help="gdal driver of the band rasters")
+    args = parser.parse_args()
+
+    size = int(args.size) if args.size.isdigit() else args.size
+    for name in make_safe_series(args.out, args.dates, size, args.level, args.driver):
+        print(name)
@@ -9,7 +9,7 @@
 docker restart s2-ard
 start=$SECONDS
 
-# parse named argument options --tile, --config and --aoi
+# parse named argument options --tile, --config, --aoi and --workers
 while :; do
     case $1 in
         -t|--tiles)
@@ -42,6 +42,16 @@ while :; do
                         exit 1
                 fi
                 ;;
+        -w|--workers)
+                if [ "$2" ]; then
+                        WORKERS=$2
+			echo "Workers : $WORKERS"
+                        shift
+                else
+                        echo 'ERROR: "--workers" requires a non-empty option argument.'
+                        exit 1
+                fi
+                ;;
         *)
                 break
     esac
@@ -76,7 +86,7 @@ else
 fi
 
 # execute pre-processing of the data product (tile or batch)
-docker exec -it s2-ard bash -c "python /app/ard.py --tiles "$TILES""
+docker exec -it s2-ard bash -c "python /app/ard.py --tiles "$TILES" --workers "${WORKERS:-1}""
 
 # copy output files/folders to host from s2-ard container
 echo "Copying files from docker container"
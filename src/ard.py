@@ -1,13 +1,18 @@
 #!/usr/bin/env python3
 import os
 from argparse import ArgumentParser
-import xml.etree.ElementTree as ET
-from osgeo import gdal
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import numpy as np
 from shutil import copyfile
 import config_reader as cfg
 import raster_mod as rm
-from raster_mod import system_call
+import metrics
+from manifest import Manifest
+from catalog import Catalog
+from scheduler import ToolScheduler, ToolError
+from tile_graph import TileGraph
+from datacube import Datacube
 
 
 def build_mosaic(input_dir, image_list, output_dir, resampling_method='cubic'):
@@ -24,44 +29,43 @@ def build_mosaic(input_dir, image_list, output_dir, resampling_method='cubic'):
         resampling_method : str
             resampling method (listed in https://gdal.org/programs/gdalwarp.html)
     """
-    # list of images to mosaic - bit hacky, can improve
-    tile_list = []
-    for image in image_list:
-        tile_path = os.path.join(input_dir, image[:-5])
-        for file in os.listdir(tile_path):
-            if os.path.isfile(os.path.join(tile_path, file)) and file.endswith('.tif'):
-                tile_list.append(os.path.join(tile_path, file))
+    # outputs of each tile, tiles ordered by sensing date / time (not by platform) - the last image in is on top
+    tile_outputs = [catalog.tile_outputs(os.path.join(input_dir, image[:-5])) for image in sorted(image_list, key=lambda image: image[11:26])]
 
     # mosaics to build based on extension (stacked, ndvi, etc...)
-    file_extensions = list(set(tile.split('_')[-1] for tile in tile_list))
+    file_extensions = sorted(set(tile.split('_')[-1] for outputs in tile_outputs for tile in outputs))
     # sensing date of images
     image_dates = [tile[11:19] for tile in image_list]
 
-    for extension in file_extensions:
-        # create a list of images to mosaic
-        to_mosaic = [tile for tile in tile_list if tile.endswith(extension)]
-        # order the list of images to mosaic (last image in is the image on top)
-        mosaic_bands = [x for _, x in sorted(zip(image_list, to_mosaic))]
+    def mosaic_extension(extension, num_threads):
+        # create the ordered list of images to mosaic
+        mosaic_bands = [tile for outputs in tile_outputs for tile in outputs if tile.endswith(extension)]
         # build mosaic
         mosaic_vrt = output_dir + os.sep + '_'.join(image_dates + ['mosaic', extension[:-4]]) + '.vrt'
-        system_command = ['gdalbuildvrt', mosaic_vrt, '-r', resampling_method] + mosaic_bands
-        system_call(system_command)
-        # convert mosaic to geotiff
         output_image = mosaic_vrt[:-4] + '.tif'
-        system_command = ["gdal_translate", "-of", "GTiff", mosaic_vrt, output_image]
-        system_call(system_command)
-
-    # cleanup
-    for file in os.listdir(output_dir):
-        if file.endswith('.vrt'):
+        mosaic_vrt = rm.build_vrt(rm.intermediate_image(mosaic_vrt), mosaic_bands, resampling_method)
+        # windowed, multi-threaded copy of the mosaic to a tiled / compressed geotiff
+        rm.export_mosaic(mosaic_vrt, output_image, num_threads=num_threads)
+        return(mosaic_vrt)
+
+    # the mosaics of the extensions are built at the same time, the cores are shared between them
+    workers = max(1, min(len(file_extensions), os.cpu_count() or 1))
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        mosaic_vrts = list(executor.map(lambda extension: mosaic_extension(extension, num_threads), file_extensions))
+
+    # cleanup - only the virtual mosaics built above
+    rm.cleanup_intermediates()
+    for mosaic_vrt in mosaic_vrts:
+        if os.path.exists(mosaic_vrt):
             try:
-                os.remove(output_dir + os.sep + file)
+                os.remove(mosaic_vrt)
             except Exception:
-                print('unable to remove: ', file)
+                print('unable to remove: ', mosaic_vrt)
 
 
-def compute_average(input_dir, image_list, output_dir):
-    """ Computes average for series of already processed sentinel-2 tiles
+def compute_average(input_dir, image_list, output_dir, composites=None, cube=None):
+    """ Computes average (and other composites) for series of already processed sentinel-2 tiles
 
         Parameters
         ----------
@@ -71,44 +75,59 @@ def compute_average(input_dir, image_list, output_dir):
             List of tiles to include in average
         output_dir : str
             Path to output directory
+        composites : list
+            composites to compute: mean (default), median, percentiles (i.e. p10, p90)
+            and max-ndvi (greenest pixel, needs the ndvi output of every tile)
+        cube : Datacube
+            optional datacube the dates are read from instead of the tile outputs
     """
-    # list of images to average - a bit hacky
-    tile_list = []
-    for image in image_list:
-        tile_path = os.path.join(input_dir, image[:-5])
-        for file in os.listdir(tile_path):
-            if os.path.isfile(os.path.join(tile_path, file)) and file.endswith('.tif'):
-                tile_list.append(os.path.join(tile_path, file))
-
-    # averages to generate based on extension (stacked, ndvi, etc...)
-    file_extensions = list(set(tile.split('_')[-1] for tile in tile_list))
-    print(input_dir)
-    print(image_list)
-    print(file_extensions)
-
+    composites = composites or ['mean']
     # sensing date of images
     image_dates = [tile.split('/')[-1][11:19] for tile in image_list]
 
-    for extension in file_extensions:
-        # build image list from extension
-        tiles = [tile for tile in tile_list if tile.endswith(extension)]
-        print('Averaging: ', extension[:-4])
-        # get tile metadata
-        tile_meta = rm.get_band_meta(tiles[0])
-        arrays = []
-        for band in range(1, tile_meta['band_num']+1):
-            print('\t Processing Band: ', band)
-            band_list = [rm.read_band(tile, band) for tile in tiles]
-            band_avg = np.nanmean(band_list, axis=0)
-            arrays.append(band_avg)
-
-        output_image = output_dir + os.sep + '_'.join(image_dates + ['averaged', extension])
-        rm.write_image(output_image, 'GTiff', tile_meta, arrays)
+    # dates of each output to average (stacked, ndvi, etc...)
+    if cube is not None:
+        # chunked by date in the datacube, no per date file to open
+        date_stacks = dict((variable + '.tif', dates) for variable, dates in cube.date_stacks(image_list).items())
+    else:
+        # outputs of each image to average - a bit hacky
+        tile_outputs = dict((image, catalog.tile_outputs(os.path.join(input_dir, image[:-5]))) for image in image_list)
+        file_extensions = sorted(set(tile.split('_')[-1] for outputs in tile_outputs.values() for tile in outputs))
+        date_stacks = {}
+        for extension in file_extensions:
+            date_stacks[extension] = rm.DateRasters([tile for image in image_list for tile in tile_outputs[image] if tile.endswith(extension)])
+    print(input_dir)
+    print(image_list)
+    print(sorted(date_stacks.keys()))
+
+    # ndvi of the same images (max-ndvi)
+    ndvi_dates = date_stacks.get('ndvi.tif')
+    for extension in sorted(date_stacks.keys()):
+        dates = date_stacks[extension]
+        methods = list(composites)
+        if 'max-ndvi' in methods and (ndvi_dates is None or len(ndvi_dates) != len(dates)):
+            print('SKIPPING MAX-NDVI COMPOSITE (ndvi missing for some images): ', extension[:-4])
+            methods.remove('max-ndvi')
+        elif 'max-ndvi' in methods and not rm.same_grid(ndvi_dates.band_meta, dates.band_meta):
+            # i.e. the 20 m fmask outputs
+            print('SKIPPING MAX-NDVI COMPOSITE (not on the ndvi grid): ', extension[:-4])
+            methods.remove('max-ndvi')
+        if not methods:
+            continue
+        print('Averaging: ', extension[:-4], methods)
+        # blockwise and in parallel, memory is bounded by the memory budget whatever the number of dates
+        out_images = dict((method, output_dir + os.sep + '_'.join(image_dates + ['averaged' if method == 'mean' else method, extension]))
+                          for method in methods)
+        rm.composite_images(dates, out_images, dates.band_meta, ndvi_dates if 'max-ndvi' in methods else None)
+
+    for dates in date_stacks.values():
+        dates.close()
+
 
 # processing the tile
 class ProcessTile():
 
-    def __init__(self, config_dict):
+    def __init__(self, config_dict, windowed=False):
 
         # read in configuration settings
         self.config = config_dict
@@ -119,7 +138,15 @@ class ProcessTile():
         # output-image-settings
         self.tile_name = self.config.tile_name
         self.bands = self.config.output_image_settings['bands']
-        self.derived_indices = self.config.output_image_settings["vi"]
+        # indices defined as band expressions (vi-expressions) are derived with the vi indices
+        expressions = dict(self.config.output_image_settings.get('vi-expressions') or {})
+        rm.register_indices(expressions)
+        self.derived_indices = list(self.config.output_image_settings["vi"] or [])
+        self.derived_indices += [index for index in expressions if index not in self.derived_indices]
+        # B10 (cirrus) is dropped by Sen2Cor, L2A products do not have it
+        if self.tile_name[7:10] == 'L2A' or self.config.ard_settings['atm-corr'] == True:
+            if 'B10' in list(self.bands) + rm.index_bands(self.derived_indices):
+                raise ValueError('band B10 is not available in L2A products ({}), remove it from the bands / index expressions'.format(self.tile_name))
 
         self.image_properties = {'resolution': self.config.output_image_settings['resolution'],
                                  't_srs': self.config.output_image_settings['t-srs'],
@@ -130,8 +157,16 @@ class ProcessTile():
         # set output dir
         self.output_dir = "/output"
 
+        # windowed mode - masks, indices, calibration and outputs in a single pass over the
+        # resampled bands, window size from the memory budget (no full scene arrays)
+        self.windowed = windowed
+
     def process_tile(self, input_tile):
 
+        # per stage / per operation timing of the tile
+        metrics.start(os.path.split(self.tile_name)[1])
+        metrics.stage('METADATA')
+
         # input product type toa (L1C) or boa (L2A)
         producttype = self.tile_name[7:10]
         if producttype == 'L2A':
@@ -143,11 +178,25 @@ class ProcessTile():
             all_bands = self._get_toa_band_pathes(metadata_xml)
             ref_bands = self._subset_toa_bands(self.bands, all_bands)
 
+        # cloud masking tools only read the input product, they are queued now and run while
+        # the bands are resampled and the indices derived
+        sen2cor_job = None
+        fmask_job = None
+        if self.config.ard_settings['cloud-mask'] == True and producttype == 'L1C':
+            if (self.config.cloud_mask_settings['sen2cor-scl-codes']) and (self.config.ard_settings['atm-corr'] == False):
+                # running sen2cor scene classification only
+                print('RUNNING SEN2COR SCENE CLASSIFICATION ONLY')
+                sen2cor_job = scheduler.submit(['L2A_Process', "--sc_only", input_tile], input_tile)
+            if self.config.cloud_mask_settings['fmask-codes']:
+                print('RUNNING FMASK CLOUD MASK')
+                fmask_image = work_dir + os.sep + '_'.join([os.path.splitext(os.path.split(input_tile)[1])[0], 'FMASK']) + '.tif'
+                fmask_job = scheduler.submit(['fmask_sentinel2Stacked.py', '-o', fmask_image, '--safedir', input_tile], input_tile)
+
         # ATMOSPHERIC CORRECTION - SEN2COR
         if self.config.ard_settings['atm-corr'] == True:
+            metrics.stage('ATMOSPHERIC CORRECTION')
             print('RUNNING ATMOSPHERIC CORRECTION - SEN2COR')
-            system_command = ['L2A_Process', "--resolution", '10', input_tile]
-            system_call(system_command)
+            scheduler.run(['L2A_Process', "--resolution", '10', input_tile], input_tile)
 
             self.tile_name = self._get_l2a_name(self.tile_name)
             all_bands = self._get_boa_band_pathes(self._get_metadata_xml(self.tile_name))
@@ -162,233 +211,52 @@ class ProcessTile():
         if self.image_properties['t_srs'] == False:
             self.image_properties['t_srs'] = rm.get_band_meta(all_bands[list(all_bands.keys())[0]])['epsg']
 
-        # RESAMPLING TO TARGET RESOLUTION
-        # resampling to target resolution if bands/image does not meet target resolution
-        for key in self.bands:
-            if rm.get_band_meta(ref_bands[key])['geotransform'][1] != self.image_properties['resolution']:
-                print('RESAMPLING BAND TO TARGET RESOLUTION: %s' % (key))
-                resampled_image = self.rename_image(work_dir, '.tif', os.path.split(os.path.splitext(self.tile_name)[0])[1], key)
-                ref_bands[key] = rm.resample_image(ref_bands[key], resampled_image, self.image_properties)
-
-        # DERIVING INDICES
-        if self.config.ard_settings["derived-index"] == True:
-            print('DERIVE INDEX / INDICES')
-            vi_band_dict = {
-                            'ndvi': ['B08', 'B04'],
-                            'ndmi': ['B08', 'B11'],
-                            'ndti': ['B11', 'B12'],
-                            'crc': ['B11', 'B02'],
-                            'vdvi': ['B02', 'B03', 'B04'],
-                            'bsi': ['B02', 'B04', 'B08', 'B11']
-                            }
-
-            derived_bands = {}
-            for index in self.derived_indices:
-                print((index, vi_band_dict[index]))
-
-                if self.config.ard_settings['atm-corr'] == False:
-                    if producttype == 'L1C':
-                        vi_bands = self._subset_toa_bands(vi_band_dict[index], all_bands)
-                        print(vi_bands)
-
-                if self.config.ard_settings['atm-corr'] == True or producttype == 'L2A':
-                    vi_bands = self._subset_boa_bands(vi_band_dict[index], all_bands)
-                    print(vi_bands)
-
-                for key in vi_bands.keys():
-                    if (rm.get_band_meta(vi_bands[key])['geotransform'][1] != self.config.output_image_settings['resolution']):
-                        print('RESAMPLING BAND TO TARGET RESOLUTION: %s' % (key))
-                        resampled_image = self.rename_image(work_dir, '.tif', os.path.split(os.path.splitext(self.tile_name)[0])[1], key)
-                        vi_bands[key] = rm.resample_image(vi_bands[key], resampled_image, self.image_properties)
-
-                # write index
-                band_meta = rm.get_band_meta(vi_bands[key])
-                band_meta['dtype'] = 6
-                if index == 'vdvi':
-                    derived_index = rm.vdvi(vi_bands[vi_band_dict[index][0]], vi_bands[vi_band_dict[index][1]], vi_bands[vi_band_dict[index][2]])
-                elif index == 'bsi':
-                    derived_index = rm.bare_soil(vi_bands[vi_band_dict[index][0]], vi_bands[vi_band_dict[index][1]], vi_bands[vi_band_dict[index][2]], vi_bands[vi_band_dict[index][3]])
-                else:
-                    derived_index = rm.normalized_diff(vi_bands[vi_band_dict[index][0]], vi_bands[vi_band_dict[index][1]])
-                derived_index_image = self.rename_image(work_dir, '.tif', os.path.splitext(os.path.split(self.tile_name)[1])[0], index)
-
-                rm.write_image(derived_index_image, "GTiff", band_meta, [derived_index])
-
-                derived_bands[index] = derived_index_image
-
-        # SEN2COR CLOUD MASKING ONLY
-        if (self.config.ard_settings['cloud-mask'] == True) and (self.config.cloud_mask_settings['sen2cor-scl-codes']):
-
-            if (self.config.ard_settings['atm-corr'] == False) and (producttype == 'L1C'):
-                # running sen2cor scene classification only
-                print('RUNNING SEN2COR SCENE CLASSIFICATION ONLY')
-                system_command = ['L2A_Process', "--sc_only", input_tile]
-                system_call(system_command)
-
-            scl_image = '.'.join([all_bands['SCL_20m']])
-            # resampling to target resolution if bands/image does not meet target resolution
-            if rm.get_band_meta(scl_image)['geotransform'][1] != self.image_properties['resolution']:
-                # changing resampling to near since cloud mask image contains discrete values
-                _image_properties = self.image_properties.copy()
-                _image_properties["resampling_method"] = "near"
-
-                resampled_image = self.rename_image(work_dir, '.tif', os.path.split(os.path.splitext(scl_image)[0])[1], 'resampled')
-                scl_image = rm.resample_image(scl_image, resampled_image, _image_properties)
-
-            mask = rm.binary_mask(rm.read_band(scl_image), self.config.cloud_mask_settings['sen2cor-scl-codes'])
-
-            # apply scl_image as mask to ref images
-            print('APPLYING SEN2COR SCENE CLASSIFICATION MASK TO REF BANDS')
-            for key in self.bands:
-                band_meta = rm.get_band_meta(ref_bands[key])
-                masked_array = rm.mask_array(mask, rm.read_band(ref_bands[key]))
-                masked_image = self.rename_image(work_dir, '.tif', os.path.splitext(os.path.basename(ref_bands[key]))[0], 'scl', 'masked')
-
-                rm.write_image(masked_image, "GTiff", band_meta, [masked_array])
-                ref_bands[key] = masked_image
-
-            # apply scl_image as mask to index images
-            print('APPLYING SEN2COR SCENE CLASSIFICATION MASK TO INDICES')
-            if self.derived_indices != False:
-                for key in self.derived_indices:
-                    band_meta = rm.get_band_meta(derived_bands[key])
-                    masked_array = rm.mask_array(mask, rm.read_band(derived_bands[key]))
-                    masked_image = self.rename_image(work_dir, '.tif', os.path.splitext(os.path.basename(derived_bands[key]))[0], 'scl', 'masked')
-
-                    rm.write_image(masked_image, "GTiff", band_meta, [masked_array])
-                    derived_bands[key] = masked_image
-
-        # FMASK CLOUD MASKING
-        if (self.config.ard_settings['cloud-mask'] == True) and (self.config.cloud_mask_settings['fmask-codes']) and (producttype == 'L1C'):
-            print('RUNNING FMASK CLOUD MASK')
-            # running fmask cloud masking
-            fmask_image = work_dir + os.sep + '_'.join([os.path.splitext(os.path.split(input_tile)[1])[0], 'FMASK']) + '.tif'
-            system_command = ['fmask_sentinel2Stacked.py', '-o', fmask_image, '--safedir', input_tile]
-            system_call(system_command)
-
-            # copying fmask image to output dir
-            output_image = self.rename_image(self.output_dir, '.tif', os.path.split(os.path.splitext(fmask_image)[0])[1])
-            copyfile(fmask_image, output_image)
-
-            # resampling to target resolution if bands/image does not meet target resolution
-            if rm.get_band_meta(fmask_image)['geotransform'][1] != self.image_properties['resolution']:
-                # changing resampling to near since cloud mask image contains discrete values
-                _image_properties = self.image_properties.copy()
-                _image_properties["resampling_method"] = "near"
-                fmask_image = rm.resample_image(fmask_image, 'resampled', _image_properties)
-
-            # applying fmask as mask to ref images
-            print('APPLYING FMASK CLOUD MASK')
-            mask = rm.binary_mask(rm.read_band(fmask_image), self.config.cloud_mask_settings['fmask-codes'])
-            for key in self.bands:
-                band_meta = rm.get_band_meta(ref_bands[key])
-                masked_array = rm.mask_array(mask, rm.read_band(ref_bands[key]))
-                masked_image = self.rename_image(work_dir, '.tif', os.path.splitext(os.path.basename(ref_bands[key]))[0], 'fmask', 'masked')
-                rm.write_image(masked_image, "GTiff", band_meta, [masked_array])
-                ref_bands[key] = masked_image
-
-            # apply fmask as mask to index images
-            print('APPLYING FMASK CLOUD MASK TO INDICES')
-            if self.derived_indices != False:
-                for key in self.derived_indices:
-                    band_meta = rm.get_band_meta(derived_bands[key])
-                    masked_array = rm.mask_array(mask, rm.read_band(derived_bands[key]))
-                    masked_image = self.rename_image(work_dir, '.tif', os.path.splitext(os.path.basename(derived_bands[key]))[0], 'fmask', 'masked')
-                    rm.write_image(masked_image, "GTiff", band_meta, [masked_array])
-                    derived_bands[key] = masked_image
-
-        # CALIBRATION
-        if self.config.ard_settings['calibrate'] == True:
-            print('CALIBRATING BANDS')
-            for key in self.bands:
-                print('CALIBRATING BAND %s' % (key))
-                ref_bands[key] = self.calibrate('.'.join([ref_bands[key]]))
-
-        # REPROJECTION
-        # ref images
-        for key in ref_bands:
-            if rm.get_band_meta(ref_bands[key])['epsg'] != str(self.image_properties['t_srs']):
-                print('REPROJECTING BAND %s' % (key))
-                warped_image = work_dir + os.sep + '_'.join([os.path.splitext(os.path.basename(ref_bands[key]))[0], '.tif', str(self.image_properties['resolution']), self.image_properties['resampling_method'], str(self.image_properties['t_srs'])])
-                ref_bands[key] = rm.warp_image(ref_bands[key], 'resampled', self.image_properties)
-
-        # index images
-        if self.config.ard_settings["derived-index"] == True:
-            for key in derived_bands:
-                if rm.get_band_meta(derived_bands[key])['epsg'] != str(self.image_properties['t_srs']):
-                    print('REPROJECTING BAND %s' % (key))
-                    warped_image = self.rename_image(work_dir, '.tif', os.path.split(os.path.basename(derived_bands[key]))[0], 'resampled', str(self.image_properties['resolution']), self.image_properties['resampling_method'], str(self.image_properties['t_srs']))
-                    derived_bands[key] = rm.warp_image(derived_bands[key], warped_image, self.image_properties)
-
-        # STACKING
-        # onyl ref images
-        if self.config.ard_settings['stack'] == True:
-            print('STACKING BANDS')
-            arrays = []
-            if len(self.bands) > 1:
-                for key in self.bands:
-                    print('STACKING BAND %s' % (key))
-                    band_meta = rm.get_band_meta(ref_bands[key])
-                    arrays.append(rm.read_band(ref_bands[key]))
-                stacked_image = self.rename_image(work_dir, '.tif', os.path.splitext(os.path.split(self.tile_name)[1])[0], 'stacked')
-                rm.write_image(stacked_image, "GTiff", band_meta, arrays)
-
-                ref_bands = {}
-                ref_bands['stacked'] = stacked_image
-
-        # add ref images dict + index images dict and loop
-        if self.config.ard_settings["derived-index"] == True:
-            ref_bands.update(derived_bands)
-
-        # copying output images to /output directory
-        for key in ref_bands.keys():
-            output_image = self.rename_image(self.output_dir, '.tif', os.path.split(os.path.splitext(self.tile_name)[0])[1], key)
-            copyfile(ref_bands[key], output_image)
+        # TILE GRAPH - resampling / reprojection (decoding the jp2 bands), calibration, indices,
+        # masks, stacking and writing as nodes run as soon as their inputs are ready, a node
+        # requested twice (i.e. a band of the outputs also used by an index) is computed once
+        metrics.stage('TILE GRAPH')
+        graph = TileGraph()
+        try:
+            outputs = self.build_graph(graph, producttype, all_bands, ref_bands, sen2cor_job, fmask_job,
+                                       fmask_image if fmask_job is not None else None)
+            # waiting for the outputs, raises the error of a failed node (i.e. ToolError)
+            graph.gather(outputs).result()
+        finally:
+            graph.close()
+
+        # free in memory intermediates of this tile
+        rm.cleanup_intermediates()
 
         # CLIPPING / CROP_TO_CUTLINE
         if self.config.ard_settings['clip'] == True:
+            metrics.stage('CLIPPING')
             rm.crop_to_cutline(self.output_dir, self.input_features)
 
+        # timing report - one json object per stage / operation
+        metrics.finish(self.rename_image(self.output_dir, '.jsonl', os.path.split(os.path.splitext(self.tile_name)[0])[1], 'timing'))
+
     # metadata xml and parsing operations
+    # answered from the product catalog (data_dir scanned once, MTD xml parsed once)
     def _get_l2a_name(self, input_tile):
-        for safe in os.listdir(data_dir):
-            tile_name = data_dir + os.sep + safe
-            if os.path.isdir(tile_name) and (os.path.split(tile_name)[1][7:10] == 'L2A') and (os.path.split(tile_name)[1][11:26] == input_tile[11:26]):
-                return(tile_name)
+        return(catalog.l2a_name(input_tile))
 
     def _get_metadata_xml(self, input_tile):
-        for i in os.listdir(input_tile):
-            if (os.path.splitext(i)[1] == '.xml') and ('MTD' in i):
-                metadata_xml = input_tile + os.sep + i
-        return(metadata_xml)
+        return(catalog.metadata_xml(input_tile))
 
     def _get_boa_band_pathes(self, metadata_xml):
-        band_pathes = {}
-        root = ET.parse(metadata_xml)
-        product = root.findall('.//Product_Organisation/Granule_List/Granule')
-        for res_dir in product:
-            for band in res_dir.findall('IMAGE_FILE'):
-                band_pathes[band.text[-7:]] = os.path.split(metadata_xml)[0] + os.sep + band.text + '.jp2'
-        return(band_pathes)
+        return(catalog.boa_band_pathes(os.path.dirname(metadata_xml)))
 
     def _get_toa_band_pathes(self, metadata_xml):
-        band_pathes = {}
-        root = ET.parse(metadata_xml)
-        product = root.findall('.//Product_Organisation/Granule_List/Granule')
-        for res_dir in product:
-            for band in res_dir.findall('IMAGE_FILE'):
-                band_pathes[band.text[-3:]] = os.path.split(metadata_xml)[0] + os.sep + band.text + '.jp2'
-        return(band_pathes)
+        return(catalog.toa_band_pathes(os.path.dirname(metadata_xml)))
 
     def _subset_boa_bands(self, subset_bands, band_pathes):
+        # finest resolution of each band (B01 / B09 only exist at 60 m, B10 not at all in L2A)
         subset_band_pathes = {}
         for band in subset_bands:
-            key = '_'.join([band, '10m'])
-            if key in band_pathes.keys():
-                subset_band_pathes[key[:3]] = band_pathes[key]
-            if key not in band_pathes.keys():
-                key = '_'.join([band, '20m'])
-                subset_band_pathes[key[:3]] = band_pathes[key]
+            keys = [key for key in ('_'.join([band, resolution]) for resolution in ('10m', '20m', '60m')) if key in band_pathes]
+            if not keys:
+                raise ValueError('band {} is not available in the L2A product {}'.format(band, self.tile_name))
+            subset_band_pathes[band] = band_pathes[keys[0]]
         return(subset_band_pathes)
 
     def _subset_toa_bands(self, subset_bands, all_bands):
@@ -398,19 +266,205 @@ class ProcessTile():
                 ref_bands[key] = all_bands[key]
         return(ref_bands)
 
+    def to_target_grid(self, image, output_image, key, image_properties=None):
+        """ Brings an image to the target resolution and spatial reference system
+
+            When the spatial reference differs from the target, resampling and
+            reprojection are planned as a single warp so the image is interpolated
+            and written once, otherwise it is only resampled (if needed).
+
+            Parameters
+            ----------
+            image : str
+                file path to input raster
+            output_image : str
+                file path to resampled / warped image
+            key : str
+                band name (for logging)
+            image_properties : dict
+                target grid settings, defaults to the tile image properties
+
+            Returns
+            -------
+            str
+                path to image on the target grid
+        """
+        if image_properties is None:
+            image_properties = self.image_properties
+        band_meta = rm.get_band_meta(image)
+
+        if band_meta['epsg'] != str(image_properties['t_srs']):
+            print('RESAMPLING AND REPROJECTING BAND TO TARGET GRID: %s' % (key))
+            image = rm.warp_image(image, output_image, image_properties)
+            if 'te' not in self.image_properties:
+                # the first warp fixes the target extent so every image lands on the same grid
+                self.image_properties['te'] = rm.get_bounds(image)
+            return(image)
+
+        if band_meta['geotransform'][1] != image_properties['resolution']:
+            print('RESAMPLING BAND TO TARGET RESOLUTION: %s' % (key))
+            return(rm.resample_image(image, output_image, image_properties))
+
+        return(image)
+
+    def build_graph(self, graph, producttype, all_bands, ref_bands, sen2cor_job=None, fmask_job=None, fmask_image=None):
+        """ Adds the operations of the tile to a TileGraph
+
+            Parameters
+            ----------
+            graph : TileGraph
+                graph of the tile
+            producttype : str
+                'L1C' or 'L2A'
+            all_bands : dict
+                all band / mask images of the product
+            ref_bands : dict
+                output bands of the product
+            sen2cor_job, fmask_job : Future
+                queued cloud masking tools, the mask nodes wait for them
+            fmask_image : str
+                file path to the fmask output
+
+            Returns
+            -------
+            dict
+                write nodes by output name
+        """
+        tile_base = os.path.split(os.path.splitext(self.tile_name)[0])[1]
+        cloud_mask_settings = self.config.cloud_mask_settings if self.config.ard_settings['cloud-mask'] == True else {}
+
+        # the first warp fixes the target extent (see to_target_grid), the other images are warped after it
+        pin = ()
+        first_band = ref_bands[self.bands[0]]
+        if rm.get_band_meta(first_band)['epsg'] != str(self.image_properties['t_srs']):
+            pin = (self.grid_node(graph, first_band, self.bands[0]),)
+
+        # RESAMPLING TO TARGET RESOLUTION (AND REPROJECTION TO TARGET SRS IN THE SAME WARP)
+        bands = {}
+        for key in self.bands:
+            bands[key] = self.grid_node(graph, ref_bands[key], key, after=pin)
+            # CALIBRATION
+            if self.config.ard_settings['calibrate'] == True:
+                bands[key] = graph.node(('calibrate', key), self.calibrate, bands[key])
+            # REPROJECTION - only catches images that did not go through to_target_grid
+            bands[key] = graph.node(('warp', key), self.on_target_srs, bands[key], key)
+
+        # DERIVING INDICES - the index bands are the band nodes above when they are shared
+        indices = self.derived_indices if self.config.ard_settings["derived-index"] == True else []
+        vi_bands = None
+        if indices:
+            if self.config.ard_settings['atm-corr'] == False and producttype == 'L1C':
+                vi_bands = self._subset_toa_bands(rm.index_bands(indices), all_bands)
+            else:
+                vi_bands = self._subset_boa_bands(rm.index_bands(indices), all_bands)
+            vi_bands = graph.gather(dict((key, self.grid_node(graph, vi_bands[key], key, after=pin)) for key in vi_bands))
+
+        # CLOUD MASKING - (mask on the target grid, pixel values to keep), nearest neighbour
+        # resampling since the masks contain discrete values
+        mask_layers = []
+        # nodes without dependent outputs, waited for with the outputs
+        copies = {}
+        if cloud_mask_settings and cloud_mask_settings['sen2cor-scl-codes']:
+            scl_image = self.grid_node(graph, all_bands['SCL_20m'], 'SCL', 'near',
+                                       pin + ((sen2cor_job,) if sen2cor_job is not None else ()))
+            mask_layers.append(graph.node(('mask layer', 'SCL'), lambda image: (image, cloud_mask_settings['sen2cor-scl-codes']), scl_image))
+        if cloud_mask_settings and cloud_mask_settings['fmask-codes'] and producttype == 'L1C':
+            # copying fmask image to output dir
+            output_image = self.rename_image(self.output_dir, '.tif', os.path.split(os.path.splitext(fmask_image)[0])[1])
+            copies['FMASK'] = graph.node(('copy', fmask_image), copyfile, fmask_image, output_image, after=(fmask_job,))
+            fmask_layer = self.grid_node(graph, fmask_image, 'FMASK', 'near', pin + (fmask_job,))
+            mask_layers.append(graph.node(('mask layer', 'FMASK'), lambda image: (image, cloud_mask_settings['fmask-codes']), fmask_layer))
+        mask_layers = graph.gather(mask_layers)
+
+        stack = self.config.ard_settings['stack'] == True and len(self.bands) > 1
+        if self.windowed:
+            # SINGLE WINDOWED PASS - masking, indices, calibration, stacking and writing
+            outputs = {}
+            for key in (['stacked'] if stack else list(self.bands)) + list(indices):
+                outputs[key] = self.rename_image(self.output_dir, '.tif', tile_base, key)
+            band_list = graph.gather([bands[key] for key in self.bands])
+            write = graph.node(('write', 'windowed'), lambda band_list, vi_bands, mask_layers: rm.write_tile_windowed(
+                list(zip(self.bands, band_list)), outputs, indices, vi_bands, mask_layers, stack),
+                band_list, vi_bands, mask_layers)
+            copies['windowed'] = write
+            return(copies)
+
+        # combined cloud mask, applied when the final products are written
+        cloud_mask = graph.node(('mask', ), self.write_cloud_mask, mask_layers)
+
+        images = {}
+        if stack:
+            # STACKING - streamed window by window, memory does not grow with the number of bands
+            stacked_image = self.rename_image(work_dir, '.tif', tile_base, 'stacked')
+            images['stacked'] = graph.node(('stack', ), lambda band_list: rm.stack_images(band_list, stacked_image, self.bands),
+                                           graph.gather([bands[key] for key in self.bands]))
+        else:
+            images.update(bands)
+
+        if indices:
+            index_images = dict((index, self.rename_image(work_dir, '.tif', tile_base, index)) for index in indices)
+            derived_bands = graph.node(('index', ), lambda vi_bands: rm.derive_indices(
+                indices, vi_bands, index_images, rm.get_band_meta(vi_bands[rm.index_bands(indices)[0]])), vi_bands)
+            for index in indices:
+                images[index] = graph.node(('warp', index), lambda derived_bands, index: self.on_target_srs(derived_bands[index], index),
+                                           derived_bands, index)
+
+        # WRITING OUTPUTS - copying output images to /output directory
+        outputs = {}
+        for key, image in images.items():
+            output_image = self.rename_image(self.output_dir, '.tif', tile_base, key)
+            outputs[key] = graph.node(('write', key), rm.export_image, image, output_image, cloud_mask)
+        outputs.update(copies)
+        return(outputs)
+
+    def grid_node(self, graph, image, key, resampling_method=None, after=()):
+        """ Node bringing an image to the target grid (see to_target_grid), one node per source
+            image, resolution, resampling method and spatial reference system """
+        resampling_method = resampling_method or self.image_properties['resampling_method']
+        resolution = str(self.image_properties['resolution'])
+        t_srs = str(self.image_properties['t_srs'])
+
+        def to_grid(image):
+            # the target extent is only known once the first warp ran
+            image_properties = dict(self.image_properties, resampling_method=resampling_method)
+            output_image = self.rename_image(work_dir, '.tif', os.path.split(os.path.splitext(image)[0])[1], resolution, resampling_method, t_srs)
+            return(self.to_target_grid(image, output_image, key, image_properties))
+
+        return(graph.node(('grid', image, resolution, resampling_method, t_srs), to_grid, image, after=after))
+
+    def on_target_srs(self, image, key):
+        if rm.get_band_meta(image)['epsg'] != str(self.image_properties['t_srs']):
+            print('REPROJECTING BAND %s' % (key))
+            warped_image = self.rename_image(work_dir, '.tif', os.path.splitext(os.path.basename(image))[0], str(self.image_properties['resolution']), self.image_properties['resampling_method'], str(self.image_properties['t_srs']))
+            return(rm.warp_image(image, warped_image, self.image_properties))
+        return(image)
+
+    def write_cloud_mask(self, mask_layers):
+        """ Writes the scl / fmask masks as a single binary mask (a pixel is kept only if it is
+            clear in all masks), returns None without masks """
+        cloud_mask = None
+        for mask_image, pixel_values in mask_layers:
+            print('BUILDING CLOUD MASK: ' + mask_image)
+            mask_meta = rm.get_band_meta(mask_image)
+            mask = rm.binary_mask(rm.read_band(mask_image), pixel_values)
+            cloud_mask = mask if cloud_mask is None else np.multiply(cloud_mask, mask, out=cloud_mask)
+        if cloud_mask is None:
+            return(None)
+        print('WRITING COMBINED CLOUD MASK')
+        mask_meta['dtype'] = 1
+        cloud_mask_image = self.rename_image(work_dir, '.tif', os.path.splitext(os.path.split(self.tile_name)[1])[0], 'cloudmask')
+        rm.write_image(cloud_mask_image, "GTiff", mask_meta, [cloud_mask])
+        return(cloud_mask_image)
+
     def rename_image(self, basedir, extension, *argv):
         new_name = basedir + os.sep + "_".join(argv) + extension
         return(new_name)
 
     def calibrate(self, band_path):
-        calibrated_band = work_dir + os.sep + os.path.split(os.path.splitext(band_path)[0])[1] + '.tif'
-        band_meta = rm.get_band_meta(band_path)
-        src = gdal.Open(band_path)
-        scale_factor = 10000.
-        dst = src.GetRasterBand(1).ReadAsArray() / scale_factor
-        band_meta['dtype'] = 6
-        self.write_image(calibrated_band, 'GTiff', band_meta, [dst])
-        return(calibrated_band)
+        # metadata only - a vrt with scale 0.0001, applied when the outputs are written (float32
+        # reflectance) or kept as scale / offset metadata of the integer band (int16 precision)
+        calibrated_band = work_dir + os.sep + os.path.split(os.path.splitext(band_path)[0])[1] + '_calibrated.vrt'
+        return(rm.scale_image(band_path, calibrated_band, 1. / rm.SCALE_FACTOR))
 
     def get_band_arrays(self, bands):
         band_arrays = []
@@ -419,18 +473,85 @@ class ProcessTile():
         return(band_arrays)
 
 
+def run_tile(image_config, profile=None, windowed=False):
+    """ Processes a single tile (runs in a worker process when --workers > 1)
+
+        Parameters
+        ----------
+        image_config : ImageReader
+            tile settings from the configuration file
+        profile : str
+            optional profiler ('cprofile' or 'pyinstrument'), the dump is written
+            to the tile output directory
+        windowed : bool
+            process the tile in a single windowed pass (see --memory-budget)
+
+        Returns
+        -------
+        tuple
+            (configured tile name, processed tile name) - the processed tile name
+            differs when Sen2Cor renamed the product (L1C -> L2A), None if the
+            tile could not be processed
+    """
+    input_tile = data_dir + os.sep + image_config.tile_name
+    if not os.path.isdir(input_tile):
+        print('Unable to process tile:', image_config.tile_name)
+        return(image_config.tile_name, None)
+
+    print('\n----------------------------------------------------------------------\n')
+    print('PROCESSING IMAGE: {}\n'.format(image_config.tile_name))
+    pg = ProcessTile(image_config, windowed)
+    profiler = metrics.start_profiler(profile) if profile else None
+    try:
+        pg.process_tile(input_tile)
+    except ToolError as error:
+        # the tile is reported as failed (and not recorded in the manifest), the other tiles go on
+        print('FAILED TILE: {}\n{}'.format(image_config.tile_name, error))
+        return(image_config.tile_name, None)
+    finally:
+        if profiler:
+            metrics.stop_profiler(profiler, pg.rename_image(pg.output_dir, '', os.path.split(os.path.splitext(pg.tile_name)[0])[1], 'profile'))
+    return(image_config.tile_name, os.path.split(pg.tile_name)[1])
+
+
+def run_tile_index(index):
+    return(run_tile(ard_settings.image_list[index], args.profile, args.memory_budget is not None))
+
+
 if __name__ == "__main__":
     # parse command line arguments
     desc = "Sentinel-2 Analysis Ready Data"
     parser = ArgumentParser(description=desc)
     parser.add_argument("--tiles", "-t", type=str, dest='tiles', help="Sentinel-2 data product name", required=True)
+    parser.add_argument("--workers", "-w", type=int, dest='workers', default=1, help="number of tiles processed in parallel")
+    parser.add_argument("--gdal-backend", type=str, dest='gdal_backend', default='subprocess', choices=['subprocess', 'api'],
+                        help="run gdal_translate / gdalwarp / gdalbuildvrt as subprocesses or in-process")
+    parser.add_argument("--intermediates", type=str, dest='intermediates', default='disk', choices=['disk', 'vsimem', 'vrt'],
+                        help="storage of intermediate rasters with the api gdal backend")
+    parser.add_argument("--force", action='store_true', dest='force',
+                        help="process every tile and product even if the manifest marks it as up to date")
+    parser.add_argument("--catalog", type=str, dest='catalog', default=None,
+                        help="json file the SAFE product catalog is persisted to / reused from")
+    parser.add_argument("--sen2cor-jobs", type=int, dest='sen2cor_jobs', default=None,
+                        help="concurrent Sen2Cor instances (default: from available cores and memory)")
+    parser.add_argument("--fmask-jobs", type=int, dest='fmask_jobs', default=None,
+                        help="concurrent Fmask instances (default: from available cores and memory)")
+    parser.add_argument("--memory-budget", type=int, dest='memory_budget', default=None,
+                        help="memory (MB) per tile - processes tiles in a single windowed pass sized to it, also bounds the composites")
+    parser.add_argument("--profile", type=str, dest='profile', nargs='?', const='cprofile', default=None, choices=['cprofile', 'pyinstrument'],
+                        help="write a cProfile (default) or pyinstrument dump per tile")
     args = parser.parse_args()
 
+    # gdal backend (inherited by tile worker processes)
+    rm.set_gdal_backend(args.gdal_backend, args.intermediates)
+    if args.memory_budget is not None:
+        rm.set_memory_budget(args.memory_budget)
+
     # data dir
     data_dir = args.tiles
 
-    # tiles
-    tile_list = os.listdir(data_dir)
+    # tiles - single scan of the data directory (persisted with --catalog)
+    catalog = Catalog(data_dir, args.catalog)
 
     # yaml
     config_file = os.path.dirname(os.path.realpath(__file__)) + os.sep + 'config.yml'
@@ -441,6 +562,9 @@ if __name__ == "__main__":
     # extract image metadata
     ard_settings = cfg.ConfigReader(config_file, aoi_file)
 
+    # output profile (plain / tiled / cloud optimized GeoTIFF)
+    rm.set_output_profile(ard_settings.output_settings)
+
     # working directories
     work_dir = "/work"
     output_dir = "/output"
@@ -450,20 +574,82 @@ if __name__ == "__main__":
     # L1C --> L2A name updates - might be a better solution
     l2a_names = {}
 
-    # PROCESS TILES
-    for image_config in ard_settings.image_list:
+    # manifest of processed tiles / products - unchanged tiles with existing outputs are skipped
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    manifest = Manifest(output_dir, rm.OUTPUT_PROFILE)
+
+    # time series datacube - the outputs of every processed tile are appended as a date
+    cube = None
+    if ard_settings.datacube_settings['build-datacube'] == True or ard_settings.average_settings.get('source') == 'datacube':
+        cube = Datacube(os.path.join(output_dir, ard_settings.datacube_settings.get('path') or 'datacube.zarr'),
+                        ard_settings.datacube_settings.get('chunks'))
+    append_cube = cube is not None and ard_settings.datacube_settings['build-datacube'] == True
+
+    # external tools (sen2cor / fmask) - limits shared by all tile workers, logs per tile
+    scheduler = ToolScheduler(output_dir + os.sep + 'logs',
+                              {'L2A_Process': args.sen2cor_jobs, 'fmask_sentinel2Stacked.py': args.fmask_jobs})
+    tile_hashes = {}
+    processed_tiles = []
+    pending = []
+    for index, image_config in enumerate(ard_settings.image_list):
         input_tile = data_dir + os.sep + image_config.tile_name
         if os.path.isdir(input_tile):
-            print('\n----------------------------------------------------------------------\n')
-            print('PROCESSING IMAGE: {}\n'.format(image_config.tile_name))
-            pg = ProcessTile(image_config)
-            pg.process_tile(input_tile)
-
-            # update L1C tile name to L2A tile name
-            if pg.tile_name != image_config.tile_name:
-                l2a_names[image_config.tile_name] = os.path.split(pg.tile_name)[1]
-        else:
-            print('Unable to process tile:', image_config.tile_name)
+            tile_hashes[image_config.tile_name] = manifest.tile_hash(image_config, catalog.metadata_xml(input_tile))
+            if not args.force and manifest.is_tile_done(image_config.tile_name, tile_hashes[image_config.tile_name]):
+                print('SKIPPING UNCHANGED TILE: {}'.format(image_config.tile_name))
+                processed_name = manifest.tiles[image_config.tile_name]['processed-name']
+                processed_tiles.append((image_config.tile_name, processed_name))
+                # tiles processed before the datacube was enabled
+                if append_cube and not cube.contains(processed_name):
+                    cube.append_tile(processed_name, catalog.tile_outputs(output_dir + os.sep + processed_name[:-5]))
+                continue
+        pending.append(index)
+
+    # tiles (config and processed names) processed in this run
+    updated_tiles = set()
+
+    def record_tile(tile_name, processed_name):
+        processed_tiles.append((tile_name, processed_name))
+        if processed_name:
+            updated_tiles.update([tile_name, processed_name])
+            manifest.update_tile(tile_name, tile_hashes[tile_name], processed_name, output_dir + os.sep + processed_name[:-5])
+            manifest.save()
+            # appended by the main process only, the workers never write to the cube
+            if append_cube:
+                cube.append_tile(processed_name, catalog.tile_outputs(output_dir + os.sep + processed_name[:-5]))
+
+    # PROCESS TILES
+    if args.workers > 1:
+        # tiles are independent, work_dir / data_dir / ard_settings are inherited by the forked
+        # workers so only the index of the tile is sent (yaml settings are not reliably picklable)
+        print('PROCESSING {} TILES WITH {} WORKERS'.format(len(pending), args.workers))
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            futures = [executor.submit(run_tile_index, index) for index in pending]
+            # the manifest is saved as soon as a tile finishes so an interrupted run can resume
+            for future in as_completed(futures):
+                record_tile(*future.result())
+    else:
+        for index in pending:
+            record_tile(*run_tile_index(index))
+
+    # tiles that failed in this run (see the FAILED TILE messages and the tool logs)
+    failed_tiles = [tile_name for tile_name, processed_name in processed_tiles if not processed_name]
+    if failed_tiles:
+        print('FAILED TILES: {}'.format(', '.join(failed_tiles)))
+        # failed tiles have no outputs, they are left out of the mosaic and the average
+        for product, settings in (('MOSAIC', ard_settings.mosaic_settings), ('AVERAGE', ard_settings.average_settings)):
+            skipped = [tile_name for tile_name in failed_tiles if tile_name in (settings.get('image-list') or [])]
+            if skipped:
+                print('SKIPPING FAILED TILES IN {}: {}'.format(product, ', '.join(skipped)))
+                settings['image-list'] = [image for image in settings['image-list'] if image not in skipped]
+                if not settings['image-list']:
+                    print('NO TILES LEFT, SKIPPING {}'.format(product))
+
+    # update L1C tile name to L2A tile name
+    for tile_name, processed_name in processed_tiles:
+        if processed_name and processed_name != tile_name:
+            l2a_names[tile_name] = processed_name
 
     # update L1C product name to L2A name if Sen2Cor atmospheric correction occured
     if ard_settings.average_settings['compute-average'] == True:
@@ -473,7 +659,7 @@ if __name__ == "__main__":
                 ard_settings.average_settings['image-list'].append(val)
 
     # MOSAIC IMAGES
-    if ard_settings.mosaic_settings['build-mosaic'] == True:
+    if ard_settings.mosaic_settings['build-mosaic'] == True and ard_settings.mosaic_settings['image-list']:
         print('\n----------------------------------------------------------------------\n')
         print("BUILDING TILE MOSAIC...")
         if not os.path.exists(mosaic_dir):
@@ -485,19 +671,27 @@ if __name__ == "__main__":
                 ard_settings.mosaic_settings['image-list'].remove(key)
                 ard_settings.mosaic_settings['image-list'].append(val)
 
-        # build tile mosaic
-        build_mosaic(output_dir, ard_settings.mosaic_settings['image-list'], mosaic_dir, ard_settings.mosaic_settings['resampling-method'])
+        # rebuild only if a tile of the mosaic changed (or the mosaic settings / outputs)
+        mosaic_hash = manifest.product_hash(ard_settings.mosaic_settings, ard_settings.mosaic_settings['image-list'])
+        if not args.force and not updated_tiles.intersection(ard_settings.mosaic_settings['image-list']) and manifest.is_product_done('mosaic', mosaic_hash):
+            print('SKIPPING UNCHANGED MOSAIC')
+        else:
+            # build tile mosaic
+            build_mosaic(output_dir, ard_settings.mosaic_settings['image-list'], mosaic_dir, ard_settings.mosaic_settings['resampling-method'])
+
+            # clip image chips
+            if ard_settings.mosaic_settings['clip'] == True:
+                if ard_settings.mosaic_settings['aoi-file'] == False:
+                    mosaic_aoi_file = aoi_file
+                else:
+                    mosaic_aoi_file = os.path.join(data_dir, ard_settings.mosaic_settings['aoi-file'])
+                rm.crop_to_cutline(mosaic_dir, mosaic_aoi_file)
 
-        # clip image chips
-        if ard_settings.mosaic_settings['clip'] == True:
-            if ard_settings.mosaic_settings['aoi-file'] == False:
-                mosaic_aoi_file = aoi_file
-            else:
-                mosaic_aoi_file = os.path.join(data_dir, ard_settings.mosaic_settings['aoi-file'])
-            rm.crop_to_cutline(mosaic_dir, mosaic_aoi_file)
+            manifest.update_product('mosaic', mosaic_hash, mosaic_dir)
+            manifest.save()
 
     # AVERAGE IMAGES
-    if ard_settings.average_settings['compute-average'] == True:
+    if ard_settings.average_settings['compute-average'] == True and ard_settings.average_settings['image-list']:
         print('\n----------------------------------------------------------------------\n')
         print("AVERAGING IMAGES...")
         if not os.path.exists(average_dir):
@@ -509,7 +703,16 @@ if __name__ == "__main__":
                 ard_settings.average_settings['image-list'].remove(key)
                 ard_settings.average_settings['image-list'].append(val)
 
-        compute_average(output_dir, ard_settings.average_settings['image-list'], average_dir)
+        # recompute only if a tile of the average changed (or the average settings / outputs)
+        average_hash = manifest.product_hash(ard_settings.average_settings, ard_settings.average_settings['image-list'])
+        if not args.force and not updated_tiles.intersection(ard_settings.average_settings['image-list']) and manifest.is_product_done('average', average_hash):
+            print('SKIPPING UNCHANGED AVERAGE')
+        else:
+            compute_average(output_dir, ard_settings.average_settings['image-list'], average_dir, ard_settings.average_settings['composites'],
+                            cube if ard_settings.average_settings['source'] == 'datacube' else None)
+
+            if ard_settings.average_settings['clip'] == True:
+                rm.crop_to_cutline(average_dir, aoi_file)
 
-        if ard_settings.average_settings['clip'] == True:
-            rm.crop_to_cutline(average_dir, aoi_file)
+            manifest.update_product('average', average_hash, average_dir)
+            manifest.save()
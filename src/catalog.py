@@ -0,0 +1,135 @@
+import os
+import json
+import xml.etree.ElementTree as ET
+
+# version of the catalog entries, catalog files of another version are rebuilt
+CATALOG_VERSION = 2
+
+
+# index of the SAFE products in the data directory - built from a single directory scan, every
+# MTD xml is parsed once (optionally persisted as json and reused by later runs)
+class Catalog(object):
+
+    def __init__(self, data_dir, catalog_file=None):
+
+        self.data_dir = data_dir
+        self.catalog_file = catalog_file
+        self.products = {}
+        # output directory listings (build_mosaic / compute_average)
+        self.outputs = {}
+
+        if catalog_file and os.path.exists(catalog_file):
+            try:
+                with open(catalog_file, 'r') as stream:
+                    catalog = json.load(stream)
+                if catalog.get('version') == CATALOG_VERSION:
+                    self.products = catalog.get('products', {})
+            except ValueError:
+                print('unable to read catalog, rebuilding: ', catalog_file)
+
+        self.scan()
+
+    def scan(self):
+        """ Lists the data directory and parses the metadata of new or changed products """
+        names = set()
+        for name in os.listdir(self.data_dir):
+            product_dir = self.data_dir + os.sep + name
+            if not os.path.isdir(product_dir):
+                continue
+            names.add(name)
+            mtime = os.stat(product_dir).st_mtime
+            if name in self.products and self.products[name]['mtime'] == mtime:
+                continue
+            product = self._parse_product(product_dir)
+            if product is not None:
+                product['mtime'] = mtime
+                self.products[name] = product
+
+        # products removed from the data directory
+        for name in list(self.products.keys()):
+            if name not in names:
+                del self.products[name]
+
+        if self.catalog_file:
+            self.save()
+
+    def save(self):
+        # temporary file per process then replaced, tile workers (forked processes) rescanning
+        # after Sen2Cor save the catalog at the same time
+        tmp_file = '{}.{}.tmp'.format(self.catalog_file, os.getpid())
+        with open(tmp_file, 'w') as stream:
+            json.dump({'version': CATALOG_VERSION, 'data-dir': self.data_dir, 'products': self.products}, stream, indent=2, sort_keys=True)
+        os.replace(tmp_file, self.catalog_file)
+
+    def _parse_product(self, product_dir):
+        """ Parses the MTD xml of a SAFE product
+
+            Parameters
+            ----------
+            product_dir : str
+                path to SAFE directory
+
+            Returns
+            -------
+            dict
+                tile id, sensing time, product level, metadata xml and band pathes
+                (boa keys 'B02_10m', toa keys 'B02'), None if the directory has no MTD xml
+        """
+        metadata_xml = None
+        for i in os.listdir(product_dir):
+            if (os.path.splitext(i)[1] == '.xml') and ('MTD' in i):
+                metadata_xml = product_dir + os.sep + i
+        if metadata_xml is None:
+            return(None)
+
+        name = os.path.basename(product_dir)
+        product = {'tile-id': name[38:44],
+                   'sensing-time': name[11:26],
+                   'level': name[7:10],
+                   'metadata-xml': metadata_xml,
+                   'boa-bands': {},
+                   'toa-bands': {}}
+        root = ET.parse(metadata_xml)
+        for res_dir in root.findall('.//Product_Organisation/Granule_List/Granule'):
+            for band in res_dir.findall('IMAGE_FILE'):
+                band_path = product_dir + os.sep + band.text + '.jp2'
+                product['boa-bands'][band.text[-7:]] = band_path
+                product['toa-bands'][band.text[-3:]] = band_path
+        return(product)
+
+    def product(self, input_tile):
+        """ Catalog entry of a product (SAFE name or path), rescans once if it is unknown """
+        name = os.path.basename(os.path.normpath(input_tile))
+        if name not in self.products:
+            self.scan()
+        return(self.products.get(name))
+
+    def metadata_xml(self, input_tile):
+        return(self.product(input_tile)['metadata-xml'])
+
+    def boa_band_pathes(self, input_tile):
+        return(dict(self.product(input_tile)['boa-bands']))
+
+    def toa_band_pathes(self, input_tile):
+        return(dict(self.product(input_tile)['toa-bands']))
+
+    def l2a_name(self, input_tile):
+        """ Path to the L2A product (Sen2Cor output) of an L1C product """
+        l1c = self.product(input_tile)
+        if l1c is None:
+            return(None)
+        for rescan in (False, True):
+            # the L2A product is created during the run, rescan once if it is not catalogued yet
+            if rescan:
+                self.scan()
+            for name, product in sorted(self.products.items()):
+                if (product['level'] == 'L2A') and (product['tile-id'], product['sensing-time']) == (l1c['tile-id'], l1c['sensing-time']):
+                    return(self.data_dir + os.sep + name)
+        return(None)
+
+    def tile_outputs(self, tile_dir):
+        """ GeoTIFFs in a tile output directory, listed once per run """
+        if tile_dir not in self.outputs:
+            self.outputs[tile_dir] = sorted(os.path.join(tile_dir, file) for file in os.listdir(tile_dir)
+                                            if os.path.isfile(os.path.join(tile_dir, file)) and file.endswith('.tif'))
+        return(self.outputs[tile_dir])
@@ -36,8 +36,12 @@ class ConfigReader(object):
         # parse average settings
         if config['average-settings']['compute-average'] is True:
             try:
-                self.average_keywords = ["compute-average", "clip"]
+                self.average_keywords = ["compute-average", "clip", "composites", "source"]
                 self.average_settings = self.parse_settings(self.average_keywords, config['average-settings'])
+                # mean (default), median, percentiles (p10, p90, ...) and / or max-ndvi
+                self.average_settings['composites'] = list(self.average_settings.get('composites') or ['mean'])
+                # dates read from the tile outputs (default) or the datacube
+                self.average_settings['source'] = self.average_settings.get('source') or 'tiles'
                 self.average_settings['image-list'] = []
                 for i in config['average-settings']['image-list']:
                     self.average_settings['image-list'].append(config['average-settings']['image-list'][i])
@@ -49,6 +53,22 @@ class ConfigReader(object):
             self.average_settings = {}
             self.average_settings['compute-average'] = False
 
+        # parse datacube settings (optional, no datacube if missing)
+        self.datacube_keywords = ["build-datacube", "path", "chunks"]
+        if 'datacube-settings' in config and config['datacube-settings']:
+            self.datacube_settings = self.parse_settings(self.datacube_keywords, config['datacube-settings'])
+            self.datacube_settings['build-datacube'] = self.datacube_settings.get('build-datacube') == True
+            self.datacube_settings['chunks'] = dict(self.datacube_settings.get('chunks') or {})
+        else:
+            self.datacube_settings = {'build-datacube': False}
+
+        # parse output settings (optional, plain GeoTIFF outputs if missing)
+        self.output_keywords = ["profile", "compress", "predictor", "overviews", "num-threads", "precision"]
+        if 'output-settings' in config and config['output-settings']:
+            self.output_settings = self.parse_settings(self.output_keywords, config['output-settings'])
+        else:
+            self.output_settings = {}
+
     def parse_settings(self, keywords, config):
         param_dict = {}
         for key in keywords:
@@ -88,7 +108,7 @@ class ImageReader(object):
 
         # validate output-image-settings
         try:
-            self.output_image_keywords = ["bands", "vi", "resampling-method", "t-srs", "resolution"]
+            self.output_image_keywords = ["bands", "vi", "vi-expressions", "resampling-method", "t-srs", "resolution"]
             self.output_image_settings = self.parse_settings(
                 self.output_image_keywords, config['output-image-settings'])
 
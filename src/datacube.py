@@ -0,0 +1,228 @@
+import os
+import numpy as np
+from osgeo import gdal
+from osgeo import gdal_array
+import raster_mod as rm
+from metrics import traced
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+# chunk sizes of the cube variables - a chunk always holds a single date
+DEFAULT_CHUNKS = {'band': 1, 'y': 1024, 'x': 1024}
+
+
+def product_time(product_name):
+    """ Sensing date / time of a SAFE product name (i.e. 20190521T235251) """
+    return(os.path.split(product_name)[1][11:26])
+
+
+def chunk_windows(x_size, y_size, chunk_x, chunk_y, window_size=None, max_pixels=None):
+    """ Windows covering a grid aligned to the cube chunks (see rm.block_windows) """
+    window_size = window_size or max(chunk_x, chunk_y)
+    step_x = max(chunk_x, (window_size // chunk_x) * chunk_x)
+    step_y = max(chunk_y, (window_size // chunk_y) * chunk_y)
+    if max_pixels and step_x * step_y > max_pixels:
+        step_y = max(chunk_y, ((max_pixels // step_x) // chunk_y) * chunk_y)
+    windows = []
+    for yoff in range(0, y_size, step_y):
+        for xoff in range(0, x_size, step_x):
+            windows.append((xoff, yoff, min(step_x, x_size - xoff), min(step_y, y_size - yoff)))
+    return(windows)
+
+
+# time series cube of the tile outputs - a zarr group per tile id holding one (time, band, y, x)
+# array per output (stacked, bands, indices), runs append their dates to the existing cube - the
+# time axis is in arrival order (data is never moved), 'order' lists its indices by sensing time
+class Datacube(object):
+
+    def __init__(self, cube_path, chunks=None):
+        """ Opens (or creates) the cube
+
+            Parameters
+            ----------
+            cube_path : str
+                path to the zarr store (directory)
+            chunks : dict
+                chunk sizes of new variables along 'band', 'y' and 'x', missing keys
+                default to DEFAULT_CHUNKS (existing variables keep their chunks)
+        """
+        if zarr is None:
+            raise ImportError('the datacube needs the zarr package (conda install -c conda-forge zarr)')
+        self.cube_path = cube_path
+        self.chunks = dict(DEFAULT_CHUNKS)
+        self.chunks.update(dict(chunks or {}))
+        self.root = zarr.open_group(cube_path, mode='a')
+
+    def _tile_group(self, tile_id, band_meta):
+        """ Group of a tile id, the grid of the tile is checked against the cube """
+        group = self.root.require_group(tile_id)
+        grid = {'geotransform': list(band_meta['geotransform']), 'crs': band_meta['crs'], 'epsg': band_meta['epsg'],
+                'X': band_meta['X'], 'Y': band_meta['Y']}
+        if 'geotransform' not in group.attrs:
+            group.attrs.update(grid)
+            group.attrs.update({'time': [], 'products': [], 'order': []})
+        elif [group.attrs[key] for key in ('geotransform', 'X', 'Y', 'epsg')] != [grid[key] for key in ('geotransform', 'X', 'Y', 'epsg')]:
+            raise ValueError('grid of {} differs from the datacube, use another datacube path'.format(tile_id))
+        return(group)
+
+    def contains(self, product_name):
+        tile_id = os.path.split(product_name)[1][38:44]
+        return(tile_id in self.root and product_time(product_name) in self.root[tile_id].attrs.get('time', []))
+
+    @traced
+    def append_tile(self, product_name, image_list, num_threads=None):
+        """ Appends the outputs of a processed tile as a new date (or rewrites the date)
+
+            Parameters
+            ----------
+            product_name : str
+                SAFE name of the processed product, gives the tile id and the date
+            image_list : list
+                output GeoTIFFs of the tile (<product>_<output>.tif) on the tile grid
+            num_threads : int
+                number of windows written at the same time (default: number of cores)
+        """
+        if not image_list:
+            return
+        product_name = os.path.split(product_name)[1]
+        print('APPENDING TO DATACUBE: {} ({})'.format(product_name, self.cube_path))
+        # outputs on the target grid (the largest), others (i.e. the 20 m fmask copy) are skipped
+        metas = dict((image, rm.get_band_meta(image)) for image in image_list)
+        grid_meta = max(metas.values(), key=lambda band_meta: band_meta['X'] * band_meta['Y'])
+        group = self._tile_group(product_name[38:44], grid_meta)
+        times = list(group.attrs['time'])
+        products = list(group.attrs['products'])
+        time = product_time(product_name)
+        new_date = time not in times
+        if not new_date:
+            index = times.index(time)
+        else:
+            # appended after the recorded dates (a slot left by an interrupted run is reused)
+            index = len(times)
+            times.append(time)
+            products.append(product_name)
+
+        written = set()
+        for image in image_list:
+            variable = os.path.splitext(image.split('_')[-1])[0]
+            band_meta = metas[image]
+            if (band_meta['X'], band_meta['Y'], band_meta['geotransform']) != (grid_meta['X'], grid_meta['Y'], grid_meta['geotransform']):
+                print('SKIPPING DATACUBE VARIABLE (not on the tile grid): ', variable)
+                continue
+            array = self._variable(group, variable, band_meta, len(times))
+            self._write_date(array, index, image, band_meta, num_threads)
+            written.add(variable)
+
+        # every variable has the dates of the cube, missing outputs are nodata
+        for variable in group.array_keys():
+            array = group[variable]
+            if array.shape[0] < len(times):
+                array.resize((len(times), ) + array.shape[1:])
+            elif new_date and variable not in written:
+                # data of an interrupted run in the slot of the new date
+                array[index] = array.fill_value
+
+        # the dates are recorded once their data is written
+        order = sorted(range(len(times)), key=lambda date: times[date])
+        group.attrs.update({'time': times, 'products': products, 'order': order})
+
+    def _variable(self, group, variable, band_meta, time_size):
+        shape = (time_size, band_meta['band_num'], band_meta['Y'], band_meta['X'])
+        if variable not in group:
+            chunks = (1, min(self.chunks['band'], shape[1]), min(self.chunks['y'], shape[2]), min(self.chunks['x'], shape[3]))
+            array = group.create_dataset(variable, shape=shape, chunks=chunks, dtype=gdal_array.GDALTypeCodeToNumericTypeCode(band_meta['dtype']),
+                                         fill_value=band_meta['nodata'])
+            array.attrs.update({'dtype': band_meta['dtype'], 'nodata': band_meta['nodata'],
+                                'scale': band_meta.get('scale'), 'offset': band_meta.get('offset')})
+            return(array)
+        array = group[variable]
+        if array.shape[1:] != shape[1:]:
+            raise ValueError('{} has {} bands / size {} in the datacube, {} / {} in the tile'.format(
+                variable, array.shape[1], array.shape[2:], shape[1], shape[2:]))
+        if array.shape[0] < time_size:
+            array.resize(shape)
+        return(array)
+
+    def _write_date(self, array, index, image, band_meta, num_threads=None):
+        # chunk aligned windows, every chunk of the date is written once
+        windows = chunk_windows(band_meta['X'], band_meta['Y'], array.chunks[3], array.chunks[2])
+        datasets = rm.ThreadDatasets()
+        band_num = array.shape[1]
+
+        def write(window):
+            xoff, yoff, xsize, ysize = window
+            data = datasets.get(image).ReadAsArray(xoff, yoff, xsize, ysize)
+            array[index, :, yoff:yoff + ysize, xoff:xoff + xsize] = data.reshape(band_num, ysize, xsize)
+
+        rm.map_windows(write, windows, num_threads or os.cpu_count() or 1)
+        datasets.close()
+
+    def date_stacks(self, image_list):
+        """ Date stacks (composite inputs) of the variables holding all dates of image_list
+
+            Parameters
+            ----------
+            image_list : list
+                SAFE names of the products, all of the same tile id
+
+            Returns
+            -------
+            dict
+                variable -> CubeDates
+        """
+        tile_ids = set(os.path.split(image)[1][38:44] for image in image_list)
+        if len(tile_ids) != 1:
+            raise ValueError('datacube composites need products of a single tile, got: {}'.format(sorted(tile_ids)))
+        tile_id = tile_ids.pop()
+        if tile_id not in self.root:
+            print('TILE NOT IN DATACUBE: ', tile_id)
+            return({})
+        group = self.root[tile_id]
+        times = list(group.attrs['time'])
+        missing = [image for image in image_list if product_time(image) not in times]
+        if missing:
+            print('PRODUCTS NOT IN DATACUBE: ', missing)
+            return({})
+        time_indices = [times.index(product_time(image)) for image in image_list]
+        return(dict((variable, CubeDates(group, variable, time_indices)) for variable in sorted(group.array_keys())))
+
+
+# dates of a cube variable read for the composites (same interface as rm.DateRasters)
+class CubeDates(object):
+
+    def __init__(self, group, variable, time_indices):
+
+        self.array = group[variable]
+        self.time_indices = list(time_indices)
+        attrs = self.array.attrs
+        self.band_meta = {'band_num': self.array.shape[1],
+                          'geotransform': list(group.attrs['geotransform']),
+                          'crs': group.attrs['crs'],
+                          'epsg': group.attrs['epsg'],
+                          'X': self.array.shape[3],
+                          'Y': self.array.shape[2],
+                          'dtype': attrs['dtype'],
+                          'datatype': gdal.GetDataTypeName(attrs['dtype']),
+                          'nodata': attrs['nodata']}
+        if attrs.get('scale'):
+            self.band_meta.update(scale=attrs['scale'], offset=attrs.get('offset') or 0.)
+
+    def __len__(self):
+        return(len(self.time_indices))
+
+    def windows(self, window_size=1024, max_pixels=None):
+        return(chunk_windows(self.band_meta['X'], self.band_meta['Y'], self.array.chunks[3], self.array.chunks[2], window_size, max_pixels))
+
+    def read(self, window, band):
+        """ Window of a band for every date as a (dates, rows, cols) float32 array, nodata as nan """
+        xoff, yoff, xsize, ysize = window
+        data = self.array.get_orthogonal_selection((self.time_indices, band - 1, slice(yoff, yoff + ysize), slice(xoff, xoff + xsize)))
+        nodata = data == self.band_meta['nodata']
+        stack = rm.decode(data, self.band_meta)
+        np.copyto(stack, np.float32(np.nan), where=nodata)
+        return(stack)
+
+    def close(self):
+        pass
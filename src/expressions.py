@@ -0,0 +1,162 @@
+import os
+import re
+import ast
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+# band variables of an index expression
+BAND_NAME = re.compile(r'^B(0[1-9]|1[0-2]|8A)$')
+# index names end up in the output file names (<tile>_<index>.tif), no '_'
+INDEX_NAME = re.compile(r'^[A-Za-z0-9-]+$')
+
+FUNCTIONS = {'sqrt': np.sqrt, 'abs': np.abs, 'log': np.log, 'exp': np.exp}
+OPERATORS = {ast.Add: ('+', np.add), ast.Sub: ('-', np.subtract), ast.Mult: ('*', np.multiply),
+             ast.Div: ('/', np.divide), ast.Pow: ('**', np.power)}
+
+# numpy kernels (without numexpr) run on blocks of BLOCK_SIZE pixels so the temporaries of
+# an expression stay in cache, the blocks of a window are computed on KERNEL_THREADS threads
+BLOCK_SIZE = 64 * 1024
+KERNEL_THREADS = os.cpu_count() or 1
+
+
+def _number(node):
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        return(node.value)
+    if hasattr(ast, 'Num') and isinstance(node, ast.Num):
+        return(node.n)
+    return(None)
+
+
+def _numexpr_source(node, bands):
+    """ numexpr source of an expression - division by zero and log of 0 are nan """
+    if isinstance(node, ast.Name):
+        if not BAND_NAME.match(node.id):
+            raise ValueError('unknown band in index expression: {}'.format(node.id))
+        bands.add(node.id)
+        return(node.id)
+    if _number(node) is not None:
+        return(repr(float(_number(node))))
+    if isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+        left, right = _numexpr_source(node.left, bands), _numexpr_source(node.right, bands)
+        if isinstance(node.op, ast.Div):
+            return('where({1} == 0, nan, {0} / {1})'.format(left, right))
+        return('({} {} {})'.format(left, OPERATORS[type(node.op)][0], right))
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        return('({}{})'.format('-' if isinstance(node.op, ast.USub) else '', _numexpr_source(node.operand, bands)))
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS and len(node.args) == 1 and not node.keywords:
+        argument = _numexpr_source(node.args[0], bands)
+        if node.func.id == 'log':
+            return('where({0} > 0, log({0}), nan)'.format(argument))
+        return('{}({})'.format(node.func.id, argument))
+    raise ValueError('unsupported operation in index expression: {}'.format(ast.dump(node)))
+
+
+def _numpy_function(node):
+    """ numpy evaluation of an (already validated) expression on a dict of band arrays """
+    if isinstance(node, ast.Name):
+        return(lambda arrays: arrays[node.id])
+    if _number(node) is not None:
+        value = np.float32(_number(node))
+        return(lambda arrays: value)
+    if isinstance(node, ast.BinOp):
+        left, right, operator = _numpy_function(node.left), _numpy_function(node.right), OPERATORS[type(node.op)][1]
+        if isinstance(node.op, ast.Div):
+            def divide(arrays):
+                denominator = right(arrays)
+                quotient = np.asarray(np.divide(left(arrays), denominator, dtype=np.float32))
+                np.copyto(quotient, np.float32(np.nan), where=(denominator == 0))
+                return(quotient)
+            return(divide)
+        return(lambda arrays: operator(left(arrays), right(arrays), dtype=np.float32))
+    if isinstance(node, ast.UnaryOp):
+        operand = _numpy_function(node.operand)
+        if isinstance(node.op, ast.USub):
+            return(lambda arrays: np.negative(operand(arrays)))
+        return(operand)
+    argument, function = _numpy_function(node.args[0]), FUNCTIONS[node.func.id]
+    if node.func.id == 'log':
+        def log(arrays):
+            values = argument(arrays)
+            result = np.asarray(np.log(values, dtype=np.float32))
+            np.copyto(result, np.float32(np.nan), where=(values <= 0))
+            return(result)
+        return(log)
+    return(lambda arrays: function(argument(arrays)))
+
+
+# spectral index compiled from a band expression, i.e. IndexKernel('ndvi', '(B08 - B04) / (B08 + B04)')
+class IndexKernel(object):
+
+    def __init__(self, name, expression):
+
+        if not INDEX_NAME.match(name):
+            raise ValueError('invalid index name (letters, digits and "-" only): {}'.format(name))
+        self.name = name
+        self.expression = expression
+        try:
+            tree = ast.parse(expression.strip(), mode='eval').body
+        except SyntaxError as error:
+            raise ValueError('invalid index expression {}: {}'.format(expression, error))
+        bands = set()
+        # numexpr source, validates the expression
+        self.source = _numexpr_source(tree, bands)
+        self.bands = sorted(bands)
+        if not self.bands:
+            raise ValueError('index expression without bands: {}'.format(expression))
+        self.function = _numpy_function(tree)
+
+    def __call__(self, arrays, out=None):
+        """ Computes the index in a single fused pass, nan for division by zero / log of 0
+
+            Parameters
+            ----------
+            arrays : dict
+                band name -> float32 reflectance array, all of the same shape
+            out : numpy array
+                optional preallocated float32 output (i.e. a window buffer)
+
+            Returns
+            -------
+            numpy array
+                float32 index values (out if given)
+        """
+        shape = arrays[self.bands[0]].shape
+        if out is None:
+            out = np.empty(shape, dtype=np.float32)
+        if numexpr is not None:
+            local_dict = dict((band, arrays[band]) for band in self.bands)
+            local_dict['nan'] = np.float32(np.nan)
+            numexpr.evaluate(self.source, local_dict=local_dict, out=out, casting='unsafe')
+            return(out)
+
+        # numpy fallback - the blocks of the window are computed on a pool of threads (numpy
+        # releases the GIL), each block only allocates block sized temporaries
+        flat_out = out.reshape(-1)
+        flat = dict((band, arrays[band].reshape(-1)) for band in self.bands)
+
+        def block(start):
+            block_arrays = dict((band, array[start:start + BLOCK_SIZE]) for band, array in flat.items())
+            # division by zero / log of 0 are nan by design (error state is per thread)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                flat_out[start:start + BLOCK_SIZE] = self.function(block_arrays)
+
+        starts = range(0, flat_out.size, BLOCK_SIZE)
+        if len(starts) <= 1 or KERNEL_THREADS <= 1:
+            for start in starts:
+                block(start)
+        else:
+            with ThreadPoolExecutor(max_workers=min(KERNEL_THREADS, len(starts))) as executor:
+                for _ in executor.map(block, starts):
+                    pass
+        return(out)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_index(expression, name='index'):
+    """ Compiled kernel of a band expression (compiled once per expression) """
+    return(IndexKernel(name, expression))
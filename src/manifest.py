@@ -0,0 +1,111 @@
+import os
+import json
+import shutil
+import hashlib
+from osgeo import gdal
+import numpy as np
+
+
+def tool_versions():
+    """ Versions of the libraries / external tools that shape the output products """
+    versions = {'gdal': gdal.VersionInfo('RELEASE_NAME'), 'numpy': np.__version__}
+    # sen2cor version is part of its install path (i.e. /Sen2Cor-02.08.00-Linux64/bin)
+    sen2cor = shutil.which('L2A_Process')
+    versions['sen2cor'] = os.path.realpath(sen2cor) if sen2cor else None
+    try:
+        import fmask
+        versions['fmask'] = getattr(fmask, '__version__', 'unknown')
+    except ImportError:
+        versions['fmask'] = None
+    return(versions)
+
+
+def hash_settings(*settings):
+    content = json.dumps(settings, sort_keys=True, default=str)
+    return(hashlib.sha256(content.encode('utf-8')).hexdigest())
+
+
+# record of processed tiles / products to skip unchanged work when a run is restarted
+class Manifest(object):
+
+    def __init__(self, output_dir, extra_settings=None):
+
+        self.manifest_file = output_dir + os.sep + 'manifest.json'
+        self.tiles = {}
+        self.products = {}
+        if os.path.exists(self.manifest_file):
+            try:
+                with open(self.manifest_file, 'r') as stream:
+                    manifest = json.load(stream)
+                self.tiles = manifest.get('tiles', {})
+                self.products = manifest.get('products', {})
+            except ValueError:
+                print('unable to read manifest, all tiles are processed: ', self.manifest_file)
+
+        # settings shared by all tiles (tool versions, output profile, ...)
+        self.versions = tool_versions()
+        self.extra_settings = extra_settings
+
+    def tile_hash(self, image_config, metadata_xml):
+        """ Content hash of a tile: tile settings, input SAFE metadata and tool versions
+
+            Parameters
+            ----------
+            image_config : ImageReader
+                tile settings from the configuration file
+            metadata_xml : str
+                path to the MTD xml of the input SAFE product
+
+            Returns
+            -------
+            str
+                sha256 hex digest
+        """
+        metadata = hashlib.sha256()
+        with open(metadata_xml, 'rb') as stream:
+            metadata.update(stream.read())
+        return(hash_settings(image_config.tile_name, image_config.ard_settings, image_config.cloud_mask_settings,
+                             image_config.output_image_settings, metadata.hexdigest(), self.versions, self.extra_settings))
+
+    def is_tile_done(self, tile_name, tile_hash):
+        entry = self.tiles.get(tile_name)
+        return(entry is not None and entry['hash'] == tile_hash and self._outputs_exist(entry))
+
+    def update_tile(self, tile_name, tile_hash, processed_name, tile_output_dir):
+        self.tiles[tile_name] = {'hash': tile_hash,
+                                 'processed-name': processed_name,
+                                 'outputs': self._list_outputs(tile_output_dir)}
+
+    def product_hash(self, settings, image_list):
+        """ Hash of a mosaic / average product: its settings and the hashes of its tiles """
+        tile_hashes = []
+        for image in image_list:
+            for tile_name, entry in self.tiles.items():
+                if image in (tile_name, entry['processed-name']):
+                    tile_hashes.append(entry['hash'])
+        return(hash_settings(settings, image_list, tile_hashes, self.extra_settings))
+
+    def is_product_done(self, product, product_hash):
+        entry = self.products.get(product)
+        return(entry is not None and entry['hash'] == product_hash and self._outputs_exist(entry))
+
+    def update_product(self, product, product_hash, product_dir):
+        self.products[product] = {'hash': product_hash, 'outputs': self._list_outputs(product_dir)}
+
+    def save(self):
+        # write to a temporary file first so an interrupted run never leaves a broken manifest
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w') as stream:
+            json.dump({'tiles': self.tiles, 'products': self.products}, stream, indent=2, sort_keys=True)
+        os.replace(tmp_file, self.manifest_file)
+
+    def _list_outputs(self, output_dir):
+        outputs = []
+        for root, _, files in os.walk(output_dir):
+            for file in files:
+                if file.endswith('.tif'):
+                    outputs.append(os.path.join(root, file))
+        return(sorted(outputs))
+
+    def _outputs_exist(self, entry):
+        return(len(entry['outputs']) > 0 and all(os.path.exists(output) for output in entry['outputs']))
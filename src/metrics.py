@@ -0,0 +1,226 @@
+import time
+import json
+import cProfile
+import resource
+import functools
+import threading
+
+
+# process level counters
+def io_counters(scope='process'):
+    """ Bytes read / written by this process or the calling thread (rchar / wchar of
+        /proc/self/io, /proc/thread-self/io) """
+    counters = {'rchar': 0, 'wchar': 0}
+    try:
+        with open('/proc/thread-self/io' if scope == 'thread' else '/proc/self/io') as stream:
+            for line in stream:
+                key, value = line.split(':')
+                counters[key] = int(value)
+    except (IOError, OSError):
+        pass
+    return(counters)
+
+
+def reset_peak_rss():
+    # linux >= 4.0 resets VmHWM (peak rss) of the process
+    try:
+        with open('/proc/self/clear_refs', 'w') as stream:
+            stream.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as stream:
+            for line in stream:
+                if line.startswith('VmHWM:'):
+                    return(int(line.split()[1]) / 1024.)
+    except (IOError, OSError):
+        pass
+    # ru_maxrss is the peak since the process started (kB on linux)
+    return(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.)
+
+
+def snapshot(scope='process'):
+    """ Counters of the process, or of the calling thread (cpu time / bytes read and written)
+        for operations running next to other threads (tile graph nodes, prefetching) """
+    counters = {'scope': scope,
+                'time': time.time(),
+                'wall': time.perf_counter(),
+                'cpu': time.process_time(),
+                'io': io_counters(),
+                'children': resource.getrusage(resource.RUSAGE_CHILDREN)}
+    if scope == 'thread':
+        counters.update(thread_cpu=time.thread_time(), thread_io=io_counters('thread'))
+    return(counters)
+
+
+def measure(before, after):
+    """ Metrics between two snapshots, child processes (gdal / sen2cor / fmask) included
+
+        Parameters
+        ----------
+        before, after : dict
+            snapshots taken with snapshot()
+
+        Returns
+        -------
+        dict
+            wall / cpu time (s), peak rss of the process (since the last stage started, operations
+            running at the same time share it) and bytes read / written (MB) - with 'thread'
+            snapshots cpu_s / read_mb / written_mb are those of the calling thread (plus child
+            processes) and the process wide values are kept as process_cpu_s / process_read_mb /
+            process_written_mb (they include the other threads running at the same time)
+    """
+    child_before, child_after = before['children'], after['children']
+    child_cpu = (child_after.ru_utime + child_after.ru_stime) - (child_before.ru_utime + child_before.ru_stime)
+    # children only report block i/o (512 byte blocks)
+    child_read = (child_after.ru_inblock - child_before.ru_inblock) * 512
+    child_written = (child_after.ru_oublock - child_before.ru_oublock) * 512
+    result = {'scope': before['scope'],
+              'start': before['time'],
+              'end': after['time'],
+              'wall_s': round(after['wall'] - before['wall'], 4),
+              'cpu_s': round(after['cpu'] - before['cpu'], 4),
+              'child_cpu_s': round(child_cpu, 4),
+              'process_peak_rss_mb': round(peak_rss_mb(), 1),
+              'child_peak_rss_mb': round(child_after.ru_maxrss / 1024., 1),
+              'read_mb': round((after['io']['rchar'] - before['io']['rchar'] + child_read) / 1024. ** 2, 3),
+              'written_mb': round((after['io']['wchar'] - before['io']['wchar'] + child_written) / 1024. ** 2, 3)}
+    if before['scope'] == 'thread':
+        for key in ('cpu_s', 'read_mb', 'written_mb'):
+            result['process_' + key] = result[key]
+        result.update(cpu_s=round(after['thread_cpu'] - before['thread_cpu'], 4),
+                      read_mb=round((after['thread_io']['rchar'] - before['thread_io']['rchar'] + child_read) / 1024. ** 2, 3),
+                      written_mb=round((after['thread_io']['wchar'] - before['thread_io']['wchar'] + child_written) / 1024. ** 2, 3))
+    return(result)
+
+
+# records the stages of a tile and the operations (system calls, raster operations) run in them
+class Tracer(object):
+
+    def __init__(self, name):
+
+        self.name = name
+        self.events = []
+        self.stage_name = None
+        self.stage_start = None
+        self.tile_start = snapshot()
+        self.lock = threading.Lock()
+
+    def stage(self, name):
+        """ Ends the current stage and starts the next one """
+        self.end_stage()
+        reset_peak_rss()
+        self.stage_name = name
+        self.stage_start = snapshot()
+
+    def end_stage(self):
+        if self.stage_name is not None:
+            self.record('stage', self.stage_name, self.stage_start, snapshot())
+            self.stage_name = None
+
+    def record(self, event_type, name, before, after, detail=None):
+        event = {'tile': self.name, 'type': event_type, 'name': name, 'stage': self.stage_name}
+        if detail is not None:
+            event['detail'] = detail
+        event.update(measure(before, after))
+        with self.lock:
+            self.events.append(event)
+
+    def write(self, report_file):
+        """ Writes the events (one json object per line) and a tile summary line """
+        self.end_stage()
+        self.record('tile', self.name, self.tile_start, snapshot())
+        with open(report_file, 'w') as stream:
+            for event in self.events:
+                stream.write(json.dumps(event) + '\n')
+        print('WRITING TIMING REPORT: ' + report_file)
+
+
+# tracer of the tile processed by this process (None when tracing is off)
+_tracer = None
+
+
+def start(name):
+    global _tracer
+    _tracer = Tracer(name)
+    return(_tracer)
+
+
+def stage(name):
+    if _tracer is not None:
+        _tracer.stage(name)
+
+
+def tracing():
+    return(_tracer is not None)
+
+
+def record(event_type, name, before, after, detail=None):
+    """ Records an event (i.e. a node of the tile graph) of the current stage """
+    if _tracer is not None:
+        _tracer.record(event_type, name, before, after, detail)
+
+
+def finish(report_file):
+    global _tracer
+    if _tracer is not None:
+        _tracer.write(report_file)
+    _tracer = None
+
+
+def _describe(args):
+    # command line of system calls, file path of raster operations
+    for arg in args:
+        if isinstance(arg, list) and arg and isinstance(arg[0], str):
+            return(' '.join(arg))
+        if isinstance(arg, str):
+            return(arg)
+    return(None)
+
+
+def traced(func):
+    """ Records every call of func as an operation of the current stage """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _tracer is None:
+            return(func(*args, **kwargs))
+        # operations run next to other threads, their own counters are recorded
+        before = snapshot('thread')
+        try:
+            return(func(*args, **kwargs))
+        finally:
+            _tracer.record('operation', func.__name__, before, snapshot('thread'), _describe(args))
+    return(wrapper)
+
+
+# profiling
+def start_profiler(kind='cprofile'):
+    """ Starts a cProfile (default) or pyinstrument profiler """
+    if kind == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+            profiler = Profiler()
+            profiler.start()
+            return(('pyinstrument', profiler))
+        except ImportError:
+            print('pyinstrument is not installed, using cProfile')
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return(('cprofile', profiler))
+
+
+def stop_profiler(profiler, dump_file):
+    """ Stops a profiler and writes its dump (<dump_file>.prof or <dump_file>.html) """
+    kind, profiler = profiler
+    if kind == 'pyinstrument':
+        profiler.stop()
+        with open(dump_file + '.html', 'w') as stream:
+            stream.write(profiler.output_html())
+        print('WRITING PROFILE: ' + dump_file + '.html')
+    else:
+        profiler.disable()
+        profiler.dump_stats(dump_file + '.prof')
+        print('WRITING PROFILE: ' + dump_file + '.prof')
@@ -1,15 +1,41 @@
 #!/usr/bin/env python3
 import os
+import copy
+import contextlib
 import subprocess
+import queue
+import threading
+import warnings
+import itertools
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 np.seterr(divide='ignore', invalid='ignore')
+# composites of pixels without any valid date are nodata
+warnings.filterwarnings('ignore', message='(All-NaN slice encountered|Mean of empty slice)', category=RuntimeWarning)
 from osgeo import gdal
 from osgeo import ogr
 import osr
 import glob
 import shutil
+from metrics import traced
+from expressions import IndexKernel, compile_index
+try:
+    from rtree import index as rtree_index
+except ImportError:
+    rtree_index = None
 
 
+# gdal backend - 'subprocess' runs the gdal command line utilities, 'api' runs the same
+# operations in-process through the gdal python bindings
+GDAL_BACKEND = 'subprocess'
+# where the api backend keeps intermediate rasters - 'disk', 'vsimem' (in memory) or 'vrt'
+INTERMEDIATES = 'disk'
+# in memory rasters created for the current tile
+_vsimem_files = []
+
+
+@traced
 def system_call(params):
     print(" ".join(params))
     return_code = subprocess.call(params)
@@ -17,10 +43,368 @@ def system_call(params):
         print(return_code)
 
 
+# dataset / metadata cache
+# open (read-only) datasets and parsed band metadata shared by the raster operations, keyed by
+# path and validated against the file mtime / size - least recently used entries are evicted,
+# a cached dataset is used by one thread at a time (gdal datasets are not thread safe)
+DATASET_CACHE_SIZE = 64
+_dataset_cache = OrderedDict()
+_meta_cache = OrderedDict()
+_cache_lock = threading.RLock()
+
+
+def _file_stamp(img_file):
+    if img_file.startswith('/vsi'):
+        stat = gdal.VSIStatL(img_file)
+        return((stat.mtime, stat.size) if stat else None)
+    try:
+        stat = os.stat(img_file)
+    except OSError:
+        return(None)
+    return((stat.st_mtime_ns, stat.st_size))
+
+
+def _cache_get(cache, img_file):
+    stamp = _file_stamp(img_file)
+    entry = cache.get(img_file)
+    if entry is not None and entry[0] == stamp:
+        cache.move_to_end(img_file)
+        return(entry[1])
+    return(None)
+
+
+def _cache_put(cache, img_file, value):
+    cache[img_file] = (_file_stamp(img_file), value)
+    cache.move_to_end(img_file)
+    while len(cache) > DATASET_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+@contextlib.contextmanager
+def open_dataset(img_file):
+    """ Opens a raster read-only through the shared dataset cache - with open_dataset(image) as src: ...
+
+        The dataset is locked for the calling thread until the with block ends, the
+        block must not call other cache functions (get_band_meta, invalidate, ...).
+
+        Parameters
+        ----------
+        img_file : str
+            file path to raster
+
+        Yields
+        ------
+        gdal.Dataset
+            cached dataset, reopened if the file changed since it was cached
+    """
+    with _cache_lock:
+        entry = _cache_get(_dataset_cache, img_file)
+        if entry is None:
+            entry = (gdal.Open(img_file), threading.Lock())
+            if entry[0] is not None:
+                _cache_put(_dataset_cache, img_file, entry)
+    with entry[1]:
+        yield(entry[0])
+
+
+def invalidate(img_file):
+    """ Drops a raster from the dataset / metadata cache, call before (re)writing it """
+    with _cache_lock:
+        _dataset_cache.pop(img_file, None)
+        _meta_cache.pop(img_file, None)
+
+
+def clear_cache():
+    with _cache_lock:
+        _dataset_cache.clear()
+        _meta_cache.clear()
+
+
+# gdal handles must not be shared with forked tile workers
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=clear_cache)
+
+
+def set_gdal_backend(backend, intermediates='disk'):
+    """ Selects how gdal_translate / gdalwarp / gdalbuildvrt operations are run
+
+        Parameters
+        ----------
+        backend : str
+            'subprocess' (command line utilities) or 'api' (in-process gdal bindings)
+        intermediates : str
+            'disk', 'vsimem' or 'vrt' - storage of intermediate rasters, anything
+            other than 'disk' requires the api backend
+    """
+    global GDAL_BACKEND, INTERMEDIATES
+    if backend not in ('subprocess', 'api'):
+        raise ValueError('unknown gdal backend: {}'.format(backend))
+    if intermediates not in ('disk', 'vsimem', 'vrt'):
+        raise ValueError('unknown intermediate storage: {}'.format(intermediates))
+    if intermediates != 'disk' and backend != 'api':
+        raise ValueError('{} intermediates require the api gdal backend'.format(intermediates))
+    GDAL_BACKEND = backend
+    INTERMEDIATES = intermediates
+
+
+@traced
+def gdal_call(operation, dst, src, **kwargs):
+    """ Runs an in-process gdal utility (gdal.Translate, gdal.Warp, gdal.BuildVRT)
+
+        Parameters
+        ----------
+        operation : function
+            gdal utility function
+        dst : str
+            full path to output file
+        src : str or list
+            input raster(s)
+        kwargs :
+            utility options (see gdal.TranslateOptions, gdal.WarpOptions, ...)
+
+        Returns
+        -------
+        str
+            path to output file
+    """
+    print(' '.join([operation.__name__, dst, str(src), str(kwargs)]))
+    invalidate(dst)
+    dataset_out = operation(dst, src, **kwargs)
+    if dataset_out is None:
+        print('{} failed: {}'.format(operation.__name__, gdal.GetLastErrorMsg()))
+    dataset_out = None
+    if dst.startswith('/vsimem/') and dst not in _vsimem_files:
+        _vsimem_files.append(dst)
+    return(dst)
+
+
+def intermediate_image(image):
+    """ Maps an intermediate raster path to the configured intermediate storage """
+    if GDAL_BACKEND == 'api' and INTERMEDIATES == 'vsimem':
+        return('/vsimem' + os.sep + os.path.basename(image))
+    if GDAL_BACKEND == 'api' and INTERMEDIATES == 'vrt':
+        return(os.path.splitext(image)[0] + '.vrt')
+    return(image)
+
+
+def intermediate_format(image):
+    if os.path.splitext(image)[1] == '.vrt':
+        return('VRT')
+    return('GTiff')
+
+
+def cleanup_intermediates():
+    """ Frees the in memory (/vsimem) rasters created since the last cleanup """
+    for image in _vsimem_files:
+        invalidate(image)
+        gdal.Unlink(image)
+    del _vsimem_files[:]
+
+
+# output profile
+# 'gtiff' - plain GeoTIFF (no creation options), 'tiled' - tiled + compressed GeoTIFF,
+# 'cog' - tiled + compressed GeoTIFF with internal overviews (Cloud-Optimized GeoTIFF layout)
+OUTPUT_PROFILE = {'profile': 'gtiff',
+                  'compress': 'DEFLATE',
+                  'predictor': True,
+                  'overviews': 'AVERAGE',
+                  'num-threads': 'ALL_CPUS',
+                  'precision': 'float32'}
+
+# reflectance / index values are stored as value * SCALE_FACTOR with the int16 precision,
+# nodata as INT16_NODATA (outside of the encoded values range)
+SCALE_FACTOR = 10000
+INT16_NODATA = -32768
+
+
+def set_output_profile(settings):
+    """ Sets the output profile used for the GeoTIFFs written by raster_mod
+
+        Parameters
+        ----------
+        settings : dict
+            output-settings from the configuration file, missing keys keep their
+            defaults
+
+            example:
+                { 'profile' : 'cog',
+                  'compress' : 'ZSTD',
+                  'predictor' : True,
+                  'overviews' : 'AVERAGE',
+                  'num-threads' : 4,
+                  'precision' : 'int16' }
+    """
+    for key, value in dict(settings).items():
+        OUTPUT_PROFILE[key] = value
+    if OUTPUT_PROFILE['profile'] not in ('gtiff', 'tiled', 'cog'):
+        raise ValueError('unknown output profile: {}'.format(OUTPUT_PROFILE['profile']))
+    if OUTPUT_PROFILE['precision'] not in ('float32', 'int16'):
+        raise ValueError('unknown output precision: {}'.format(OUTPUT_PROFILE['precision']))
+    # multi-threaded compression / warping of the in-process gdal operations
+    gdal.SetConfigOption('GDAL_NUM_THREADS', str(OUTPUT_PROFILE['num-threads']))
+
+
+def creation_options(dtype=None, tiled=False):
+    """ GeoTIFF creation options of the output profile
+
+        Parameters
+        ----------
+        dtype : int
+            gdal data type of the output raster (selects the predictor)
+        tiled : bool
+            tiled / compressed options even with the plain gtiff profile
+
+        Returns
+        -------
+        list
+            'KEY=VALUE' creation options
+    """
+    if OUTPUT_PROFILE['profile'] == 'gtiff' and not tiled:
+        return([])
+    # compress : false (or missing) writes uncompressed tiles
+    compress = 'NONE' if OUTPUT_PROFILE['compress'] in (False, None) else str(OUTPUT_PROFILE['compress']).upper()
+    options = ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'BIGTIFF=IF_SAFER',
+               'COMPRESS=' + compress,
+               'NUM_THREADS=' + str(OUTPUT_PROFILE['num-threads'])]
+    if OUTPUT_PROFILE['predictor'] and dtype is not None and compress != 'NONE':
+        # floating point predictor for float32/64, horizontal differencing for integers
+        options.append('PREDICTOR=3' if dtype in (gdal.GDT_Float32, gdal.GDT_Float64) else 'PREDICTOR=2')
+    return(options)
+
+
+# precision of the floating point products (indices, calibrated bands, averages) - all math is
+# done in float32, 'int16' stores round(value * SCALE_FACTOR) with the GeoTIFF scale / offset set
+def float_meta(band_meta):
+    """ Metadata of a floating point product derived from band_meta in the output precision """
+    meta = dict(band_meta)
+    if OUTPUT_PROFILE['precision'] == 'int16':
+        meta.update(dtype=gdal.GDT_Int16, scale=1. / SCALE_FACTOR, offset=0., nodata=INT16_NODATA)
+    else:
+        meta.update(dtype=gdal.GDT_Float32, nodata=0)
+        meta.pop('scale', None)
+        meta.pop('offset', None)
+    meta['datatype'] = gdal.GetDataTypeName(meta['dtype'])
+    return(meta)
+
+
+def reflectance(array):
+    """ Float32 reflectance of digital numbers (DN / SCALE_FACTOR) """
+    return(np.multiply(array, np.float32(1. / SCALE_FACTOR), dtype=np.float32))
+
+
+def encode(array, band_meta):
+    """ Float32 values to the storage type of a scaled (int16) product, nan is stored as nodata """
+    if not band_meta.get('scale'):
+        return(array)
+    scaled = np.subtract(array, np.float32(band_meta.get('offset', 0.)), dtype=np.float32)
+    scaled *= np.float32(1. / band_meta['scale'])
+    np.rint(scaled, out=scaled)
+    np.clip(scaled, -32767, 32767, out=scaled)
+    np.copyto(scaled, band_meta['nodata'], where=np.isnan(scaled))
+    return(scaled.astype(np.int16))
+
+
+def decode(array, band_meta):
+    """ Float32 values of a window read from a raster (scale / offset applied), nodata of a
+        scaled product as nan
+    """
+    if not band_meta.get('scale'):
+        return(array.astype(np.float32, copy=False))
+    values = np.multiply(array, np.float32(band_meta['scale']), dtype=np.float32)
+    values += np.float32(band_meta.get('offset', 0.))
+    if band_meta.get('nodata') is not None:
+        np.copyto(values, np.float32(np.nan), where=(array == band_meta['nodata']))
+    return(values)
+
+
+def is_unscaled_output(band_meta):
+    # scaled integer rasters are stored as float32 values with the float32 precision
+    return(bool(band_meta.get('scale')) and band_meta['dtype'] not in (gdal.GDT_Float32, gdal.GDT_Float64)
+           and OUTPUT_PROFILE['precision'] == 'float32')
+
+
+@traced
+def scale_image(image, scaled_image, scale, offset=0.):
+    """ Virtual copy (vrt) of a raster with a scale / offset, no pixels are read or written
+
+        Readers apply value = DN * scale + offset, raster_mod applies it while streaming
+        windows (decode) and when the outputs are written (export_image).
+
+        Parameters
+        ----------
+        image : str
+            file path to input raster
+        scaled_image : str
+            full path to output vrt
+        scale, offset : float
+            scale / offset of every band
+
+        Returns
+        -------
+        str
+            path to scaled image
+    """
+    invalidate(scaled_image)
+    with open_dataset(image) as src:
+        vrt = gdal.GetDriverByName('VRT').CreateCopy(scaled_image, src)
+    for i in range(vrt.RasterCount):
+        vrt.GetRasterBand(i + 1).SetScale(scale)
+        vrt.GetRasterBand(i + 1).SetOffset(offset)
+    vrt = None
+    return(scaled_image)
+
+
+@traced
+def finalize_image(image):
+    """ Converts a final product in place to a Cloud-Optimized GeoTIFF (cog profile only)
+
+        Internal overviews are built and the file is rewritten with the overviews
+        stored ahead of the full resolution data (COG driver when available).
+
+        Parameters
+        ----------
+        image : str
+            file path to GeoTIFF
+
+        Returns
+        -------
+        str
+            path to image
+    """
+    if OUTPUT_PROFILE['profile'] != 'cog':
+        return(image)
+    print('WRITING CLOUD OPTIMIZED GEOTIFF: ' + image)
+    invalidate(image)
+    dtype = gdal.Open(image).GetRasterBand(1).DataType
+    cog_image = os.path.splitext(image)[0] + '_cog.tif'
+    if gdal.GetDriverByName('COG') is not None:
+        options = [option for option in creation_options(dtype) if option.split('=')[0] in ('COMPRESS', 'PREDICTOR', 'NUM_THREADS', 'BIGTIFF')]
+        options.append('OVERVIEW_RESAMPLING=' + str(OUTPUT_PROFILE['overviews']).upper())
+        gdal.Translate(cog_image, image, format='COG', creationOptions=options)
+    else:
+        src = gdal.Open(image, gdal.GA_Update)
+        levels = []
+        level = 2
+        while min(src.RasterXSize, src.RasterYSize) // level >= 256:
+            levels.append(level)
+            level *= 2
+        if levels:
+            src.BuildOverviews(str(OUTPUT_PROFILE['overviews']).upper(), levels)
+        src = None
+        gdal.Translate(cog_image, image, format='GTiff', creationOptions=creation_options(dtype) + ['COPY_SRC_OVERVIEWS=YES'])
+    os.replace(cog_image, image)
+    return(image)
+
+
 # raster operations
+@traced
 def crop_to_cutline(image_dir, input_features):
     """ Crops directory of rasters to shapefile
 
+        Every raster is opened once and all its chips are written in one pass, the
+        pixel window of a chip is the bounding box of its feature and the pixels
+        outside the feature are set to nodata (0).
+
         Parameters
         ----------
         image_dir : str
@@ -31,84 +415,217 @@ def crop_to_cutline(image_dir, input_features):
 
     print('CROPPING TO CUTLINE')
     # generate image list & get src epsg
-    image_list = glob.glob(os.path.join(image_dir, '*.tif'))
+    image_list = sorted(glob.glob(os.path.join(image_dir, '*.tif')))
     t_srs = get_raster_epsg(image_list[0])
-    features_epsg = get_vector_epsg(input_features)
-    # reprojecting input_features to target_srs if not common projection
-    if features_epsg != t_srs:
-        print('REPROJECTING INPUT FEATURES TO TARGET PROJECTION')
-        t_srs_feature_aoi = image_dir + os.sep + "_".join([os.path.splitext(os.path.split(input_features)[1])[0], t_srs]) + '.geojson'
-        system_command = ['ogr2ogr', "-overwrite", "-t_srs", 'EPSG:' + t_srs, t_srs_feature_aoi, input_features]
-        system_call(system_command)
-        input_features = t_srs_feature_aoi
+    features = load_features(input_features, t_srs)
+    feature_index = FeatureIndex(features)
+
+    subdir = image_dir + os.sep + 'clipped'
+    if not os.path.exists(subdir):
+        os.mkdir(subdir)
+
+    # cutline masks are shared by the rasters on the same grid
+    masks = {}
+    for image in image_list:
+        clip_image(image, subdir, feature_index, len(features) > 1, masks)
+
+
+def load_features(input_features, epsg):
+    """ Geometries of a vector file, reprojected in memory if the file is not in epsg
+
+        Parameters
+        ----------
+        input_features : str
+            full path to input feature (shapefile / geojson / geopackage)
+        epsg : str
+            epsg code of the rasters
 
+        Returns
+        -------
+        list
+            (feature id, geometry, envelope) tuples, envelopes are (minx, maxx, miny, maxy)
+    """
     src = ogr.Open(input_features, 0)
     layer = src.GetLayer()
-    count = layer.GetFeatureCount()
+    transform = None
+    # reprojecting input_features to target_srs if not common projection
+    if get_vector_epsg(input_features) != epsg:
+        print('REPROJECTING INPUT FEATURES TO TARGET PROJECTION')
+        s_srs = layer.GetSpatialRef()
+        t_srs = osr.SpatialReference()
+        t_srs.ImportFromEPSG(int(epsg))
+        for srs in (s_srs, t_srs):
+            # gdal >= 3 uses the authority axis order (lat / lon) by default
+            if hasattr(srs, 'SetAxisMappingStrategy'):
+                srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(s_srs, t_srs)
+
+    features = []
     for feature in layer:
-        feature_id = feature.GetFID()
-        feature_shp = image_dir + os.sep + '_'.join([os.path.splitext(os.path.split(input_features)[1])[0], 'FEATURE_ID', str(feature_id)])
-        if not os.path.exists(feature_shp):
-            ftr_drv = ogr.GetDriverByName('Esri Shapefile')
-            out_feature = ftr_drv.CreateDataSource(feature_shp)
-            lyr = out_feature.CreateLayer('poly', layer.GetSpatialRef(), ogr.wkbPolygon)
-            feat = lyr.CreateFeature(feature.Clone())
-            out_feature = None
-
-        # cropping reflectance band image chips
-        for image in image_list:
-            subdir = image_dir + os.sep + 'clipped'
-            if not os.path.exists(subdir):
-                os.mkdir(subdir)
-            if count == 1:
-                image_chip = subdir + os.sep + '_'.join([os.path.split(os.path.splitext(image)[0])[1], 'clipped']) + '.tif'
-            if count > 1:
-                image_chip = subdir + os.sep + '_'.join([os.path.split(os.path.splitext(image)[0])[1], 'FEATURE_ID', str(feature_id), 'clipped']) + '.tif'
-            # cropping to cutline bands
-            crop_image(image, image_chip, feature_shp)
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+        geometry = geometry.Clone()
+        if transform is not None:
+            geometry.Transform(transform)
+        features.append((feature.GetFID(), geometry, geometry.GetEnvelope()))
     src = None
+    return(features)
+
+
+# spatial index of feature envelopes - rtree when installed, a linear envelope test otherwise
+class FeatureIndex(object):
+
+    def __init__(self, features):
+
+        self.features = features
+        self.tree = None
+        if rtree_index is not None:
+            self.tree = rtree_index.Index()
+            for i, (_, _, (minx, maxx, miny, maxy)) in enumerate(features):
+                self.tree.insert(i, (minx, miny, maxx, maxy))
+
+    def intersecting(self, bounds):
+        """ Features whose envelope intersects bounds ([xmin, ymin, xmax, ymax]) """
+        xmin, ymin, xmax, ymax = bounds
+        if self.tree is not None:
+            ids = sorted(self.tree.intersection((xmin, ymin, xmax, ymax)))
+        else:
+            ids = [i for i, (_, _, (minx, maxx, miny, maxy)) in enumerate(self.features)
+                   if minx <= xmax and maxx >= xmin and miny <= ymax and maxy >= ymin]
+        return([self.features[i] for i in ids])
+
+
+def feature_window(geotransform, envelope, x_size, y_size):
+    """ Pixel window (xoff, yoff, xsize, ysize) covering an envelope, None if it is outside the raster """
+    xmin, xres, _, ymax, _, yres = geotransform
+    minx, maxx, miny, maxy = envelope
+    x0 = max(0, int(np.floor((minx - xmin) / xres)))
+    x1 = min(x_size, int(np.ceil((maxx - xmin) / xres)))
+    y0 = max(0, int(np.floor((maxy - ymax) / yres)))
+    y1 = min(y_size, int(np.ceil((miny - ymax) / yres)))
+    if x1 <= x0 or y1 <= y0:
+        return(None)
+    return((x0, y0, x1 - x0, y1 - y0))
+
+
+def window_geotransform(geotransform, window):
+    xmin, xres, xrot, ymax, yrot, yres = geotransform
+    return([xmin + window[0] * xres, xres, xrot, ymax + window[1] * yres, yrot, yres])
+
+
+def cutline_mask(geometry, geotransform, window):
+    """ Rasterizes a feature on a pixel window, uint8 mask (1 inside the feature) """
+    dataset = gdal.GetDriverByName('MEM').Create('', window[2], window[3], 1, gdal.GDT_Byte)
+    dataset.SetGeoTransform(window_geotransform(geotransform, window))
+    features = ogr.GetDriverByName('Memory').CreateDataSource('')
+    layer = features.CreateLayer('cutline', None, geometry.GetGeometryType())
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(geometry)
+    layer.CreateFeature(feature)
+    gdal.RasterizeLayer(dataset, [1], layer, burn_values=[1])
+    mask = dataset.GetRasterBand(1).ReadAsArray()
+    dataset = None
+    features = None
+    return(mask)
 
-    # cleanup
-    for file in os.listdir(image_dir):
-        if file.endswith('.geojson'):
-            try:
-                shutil.rmtree(image_dir + os.sep + file)
-            except Exception:
-                print('unable to remove: ', image_dir + os.sep + file)
 
+@traced
+def clip_image(image, subdir, feature_index, feature_ids=True, masks=None):
+    """ Writes the chips of all features intersecting a raster
 
-def crop_image(input_image, output_image, feature_shp):
-    system_command = ['gdalwarp', "-cutline", feature_shp, '-crop_to_cutline', input_image, output_image, '-overwrite']
-    system_call(system_command)
+        Parameters
+        ----------
+        image : str
+            file path to raster
+        subdir : str
+            directory of the chips
+        feature_index : FeatureIndex
+            features (in the raster projection)
+        feature_ids : bool
+            add the feature id to the chip names (more than one feature)
+        masks : dict
+            cutline masks by (feature id, geotransform, window), reused between calls
+
+        Returns
+        -------
+        list
+            file paths of the chips
+    """
+    masks = {} if masks is None else masks
+    band_meta = get_band_meta(image)
+    # own handle, the chips are written (create_image) while it is read
+    src = gdal.Open(image)
+    chips = []
+    for feature_id, geometry, envelope in feature_index.intersecting(get_bounds(image)):
+        window = feature_window(band_meta['geotransform'], envelope, band_meta['X'], band_meta['Y'])
+        if window is None:
+            continue
+        key = (feature_id, tuple(band_meta['geotransform']), window)
+        if key not in masks:
+            masks[key] = cutline_mask(geometry, band_meta['geotransform'], window)
+
+        if feature_ids:
+            image_chip = subdir + os.sep + '_'.join([os.path.split(os.path.splitext(image)[0])[1], 'FEATURE_ID', str(feature_id), 'clipped']) + '.tif'
+        else:
+            image_chip = subdir + os.sep + '_'.join([os.path.split(os.path.splitext(image)[0])[1], 'clipped']) + '.tif'
+
+        chip_meta = dict(band_meta, X=window[2], Y=window[3], geotransform=window_geotransform(band_meta['geotransform'], window))
+        dataset_out = create_image(image_chip, 'GTiff', chip_meta, band_meta['band_num'])
+        for band_num in range(1, band_meta['band_num'] + 1):
+            write_window(dataset_out, (0, 0), mask_array(masks[key], read_window(src, window, band_num), band_meta['nodata']), band_num)
+        dataset_out = None
+        chips.append(finalize_image(image_chip))
+    src = None
+    return(chips)
 
 
 def get_raster_epsg(input_raster):
-    src = gdal.Open(input_raster)
-    proj = osr.SpatialReference(wkt=src.GetProjection())
-    return(proj.GetAttrValue('AUTHORITY', 1))
+    return(get_band_meta(input_raster)['epsg'])
 
 
 def get_band_meta(img_file):
-    band_meta = {}
-    src = gdal.Open(img_file)
-    band_meta['band_num'] = src.RasterCount
-    band_meta['geotransform'] = list(src.GetGeoTransform())
-    band_meta['crs'] = src.GetProjectionRef()
-    band_meta['epsg'] = osr.SpatialReference(wkt=src.GetProjectionRef()).GetAttrValue('AUTHORITY', 1)
-    band_meta['X'] = src.RasterXSize
-    band_meta['Y'] = src.RasterYSize
-    band_meta['dtype'] = src.GetRasterBand(1).DataType
-    band_meta['datatype'] = gdal.GetDataTypeName(band_meta["dtype"])
-    band_meta['nodata'] = src.GetRasterBand(1).GetNoDataValue()
-    band_meta['nodata'] = 0
-    return(band_meta)
-
-
+    with _cache_lock:
+        band_meta = _cache_get(_meta_cache, img_file)
+    if band_meta is None:
+        band_meta = {}
+        with open_dataset(img_file) as src:
+            band_meta['band_num'] = src.RasterCount
+            band_meta['geotransform'] = list(src.GetGeoTransform())
+            band_meta['crs'] = src.GetProjectionRef()
+            band_meta['epsg'] = osr.SpatialReference(wkt=src.GetProjectionRef()).GetAttrValue('AUTHORITY', 1)
+            band_meta['X'] = src.RasterXSize
+            band_meta['Y'] = src.RasterYSize
+            band_meta['dtype'] = src.GetRasterBand(1).DataType
+            band_meta['datatype'] = gdal.GetDataTypeName(band_meta["dtype"])
+            # outputs are written with nodata 0, int16 products with INT16_NODATA
+            nodata = src.GetRasterBand(1).GetNoDataValue()
+            band_meta['nodata'] = INT16_NODATA if band_meta['dtype'] == gdal.GDT_Int16 and nodata == INT16_NODATA else 0
+            # scaled products (int16 precision)
+            scale = src.GetRasterBand(1).GetScale()
+            if scale not in (None, 1.):
+                band_meta['scale'] = scale
+                band_meta['offset'] = src.GetRasterBand(1).GetOffset() or 0.
+        with _cache_lock:
+            _cache_put(_meta_cache, img_file, band_meta)
+    # callers modify the returned metadata (dtype, nodata, ...)
+    return(copy.deepcopy(band_meta))
+
+
+def get_bounds(img_file):
+    """ Extent of a raster as [xmin, ymin, xmax, ymax] """
+    band_meta = get_band_meta(img_file)
+    xmin, xres, _, ymax, _, yres = band_meta['geotransform']
+    return([xmin, ymax + band_meta['Y'] * yres, xmin + band_meta['X'] * xres, ymax])
+
+
+@traced
 def read_band(band_path, band_num=1):
-    src = gdal.Open(band_path)
-    return(src.GetRasterBand(band_num).ReadAsArray())
+    with open_dataset(band_path) as src:
+        return(src.GetRasterBand(band_num).ReadAsArray())
 
 
+@traced
 def resample_image(image, resampled_image, img_prop):
     """ Resamples image to a target resolution
 
@@ -132,11 +649,17 @@ def resample_image(image, resampled_image, img_prop):
             path to resampled image
     """
     print('Resolution does not meet target_resolution, resampling %s' % (image))
+    if GDAL_BACKEND == 'api':
+        resampled_image = intermediate_image(resampled_image)
+        return(gdal_call(gdal.Translate, resampled_image, image, format=intermediate_format(resampled_image),
+                         xRes=img_prop['resolution'], yRes=img_prop['resolution'], resampleAlg=str(img_prop['resampling_method'])))
     system_command = ['gdal_translate', "-tr", str(img_prop['resolution']), str(img_prop['resolution']), '-r', str(img_prop['resampling_method']), image, resampled_image]
+    invalidate(resampled_image)
     system_call(system_command)
     return(resampled_image)
 
 
+@traced
 def warp_image(image, warped_image, img_prop):
     """ Reprojects image to target crs
 
@@ -147,23 +670,71 @@ def warp_image(image, warped_image, img_prop):
         warped_image : str
             file path to resampled image
         img_prop : dict
-            contains target resolution and resampling method according to gdalwarp
-            standards.
+            contains target resolution, spatial reference system and resampling
+            method according to gdalwarp standards, optionally the target extent
+            ('te' : [xmin, ymin, xmax, ymax]) to pin the output grid.
 
             example:
                 { 'resolution' : 10,
-                  't_srs' : '4326' }
+                  't_srs' : '4326',
+                  'resampling_method' : 'cubic' }
 
         Returns
         -------
         str
             path to resampled image
     """
+    if GDAL_BACKEND == 'api':
+        warped_image = intermediate_image(warped_image)
+        return(gdal_call(gdal.Warp, warped_image, image, format=intermediate_format(warped_image),
+                         xRes=img_prop['resolution'], yRes=img_prop['resolution'], outputBounds=img_prop.get('te'),
+                         dstSRS='EPSG:' + str(img_prop['t_srs']), resampleAlg=img_prop['resampling_method']))
     system_command = ['gdalwarp', "-tr", str(img_prop['resolution']), str(img_prop['resolution']), '-t_srs', 'EPSG:' + str(img_prop['t_srs']), '-r', img_prop['resampling_method'], image, warped_image, '-overwrite']
+    if img_prop.get('te'):
+        system_command += ['-te'] + [str(bound) for bound in img_prop['te']]
+    invalidate(warped_image)
     system_call(system_command)
     return(warped_image)
 
 
+def create_image(out_name, driver, band_meta, band_num, options=None):
+    """ Creates an empty raster to be filled band by band or window by window
+
+        Parameters
+        ----------
+        out_name : str
+            full path to output file
+        driver : str
+            driver type (ex. )
+        band_meta : dict
+            output raster metadata (coordinate system, transform, cell size, etc...)
+        band_num : int
+            number of bands in the output raster
+        options : list
+            creation options, GeoTIFFs default to the options of the output profile
+
+        Returns
+        -------
+        gdal.Dataset
+            open output dataset, set to None to flush it to disk
+    """
+    invalidate(out_name)
+    if options is None:
+        options = creation_options(band_meta["dtype"]) if driver == 'GTiff' else []
+    driver = gdal.GetDriverByName(driver)
+    dataset_out = driver.Create(out_name, band_meta["X"], band_meta["Y"], band_num, band_meta["dtype"], options)
+    dataset_out.SetGeoTransform(band_meta["geotransform"])
+    dataset_out.SetProjection(band_meta["crs"])
+    dataset_out.SetMetadataItem('AREA_OR_POINT', 'Area')
+    for i in range(band_num):
+        dataset_out.GetRasterBand(i + 1).SetNoDataValue(band_meta['nodata'])
+        if band_meta.get('scale'):
+            dataset_out.GetRasterBand(i + 1).SetScale(band_meta['scale'])
+            dataset_out.GetRasterBand(i + 1).SetOffset(band_meta.get('offset', 0.))
+    return(dataset_out)
+
+
+@traced
 def write_image(out_name, driver, band_meta, arrays):
     """ Write raster to file
 
@@ -179,19 +750,562 @@ def write_image(out_name, driver, band_meta, arrays):
             list of 2d-numpy arrays to write to file
     """
     print('WRITING IMAGE: ' + out_name)
-    driver = gdal.GetDriverByName(driver)
-    dataset_out = driver.Create(out_name, band_meta["X"], band_meta["Y"], len(arrays), band_meta["dtype"])
-    dataset_out.SetGeoTransform(band_meta["geotransform"])
-    dataset_out.SetProjection(band_meta["crs"])
-    dataset_out.SetMetadataItem('AREA_OR_POINT', 'Area')
+    dataset_out = create_image(out_name, driver, band_meta, len(arrays))
     for i in range(len(arrays)):
-        band = dataset_out.GetRasterBand(i + 1)
-        band.WriteArray(arrays[i])
-        band.SetNoDataValue(band_meta['nodata'])
+        dataset_out.GetRasterBand(i + 1).WriteArray(arrays[i])
+    dataset_out = None
+
+
+@traced
+def build_vrt(vrt_image, image_list, resampling_method):
+    """ Builds a virtual mosaic (gdalbuildvrt), last image in the list is on top """
+    if GDAL_BACKEND == 'api':
+        return(gdal_call(gdal.BuildVRT, vrt_image, image_list, resampleAlg=resampling_method))
+    system_command = ['gdalbuildvrt', vrt_image, '-r', resampling_method] + image_list
+    invalidate(vrt_image)
+    system_call(system_command)
+    return(vrt_image)
+
+
+@traced
+def export_image(image, output_image, mask_image=None):
+    """ Materializes a raster (vrt, in memory or on disk) as a GeoTIFF
+
+        Parameters
+        ----------
+        image : str
+            file path to input raster
+        output_image : str
+            full path to output GeoTIFF
+        mask_image : str
+            optional binary mask raster on the same grid (1 = keep), pixels
+            outside the mask are written as 0 (nodata)
+
+        Returns
+        -------
+        str
+            path to output image
+    """
+    if mask_image or is_unscaled_output(get_band_meta(image)):
+        return(finalize_image(apply_mask_image(image, output_image, mask_image)))
+    invalidate(output_image)
+    if OUTPUT_PROFILE['profile'] == 'gtiff' and os.path.splitext(image)[1] == '.tif' and not image.startswith('/vsimem/'):
+        shutil.copyfile(image, output_image)
+        return(output_image)
+    options = creation_options(get_band_meta(image)['dtype'])
+    if GDAL_BACKEND == 'api':
+        gdal_call(gdal.Translate, output_image, image, format='GTiff', creationOptions=options)
+        return(finalize_image(output_image))
+    system_command = ["gdal_translate", "-of", "GTiff", image, output_image]
+    for option in options:
+        system_command += ['-co', option]
+    system_call(system_command)
+    return(finalize_image(output_image))
+
+
+@traced
+def export_mosaic(image, output_image, window_size=1024, num_threads=4):
+    """ Writes a (virtual) mosaic to a tiled, compressed GeoTIFF with windowed copies
+
+        Windows are read by a pool of threads, each with its own dataset handle
+        (gdal datasets are not thread safe), and written by an AsyncWriter in order
+        of completion.
+        Compression runs on the NUM_THREADS / GDAL_NUM_THREADS threads of the
+        output profile.
+
+        Parameters
+        ----------
+        image : str
+            file path to input raster (usually a vrt)
+        output_image : str
+            full path to output GeoTIFF
+        window_size : int
+            approximate window width / height in pixels
+        num_threads : int
+            number of reading threads
+
+        Returns
+        -------
+        str
+            path to output image
+    """
+    band_meta = get_band_meta(image)
+    band_num = band_meta['band_num']
+    dataset_out = create_image(output_image, 'GTiff', band_meta, band_num, creation_options(band_meta['dtype'], tiled=True))
+    datasets = ThreadDatasets()
+    writer = AsyncWriter(num_threads)
+
+    def copy_window(window):
+        src = datasets.get(image)
+        for i in range(band_num):
+            writer.write(dataset_out, window, read_window(src, window, i + 1), i + 1)
+
+    try:
+        map_windows(copy_window, block_windows(image, window_size), num_threads)
+    finally:
+        writer.close()
+    datasets.close()
+    dataset_out = None
+    return(finalize_image(output_image))
+
+
+# windowed operations
+def block_windows(img_file, window_size=1024, max_pixels=None):
+    """ Windows covering a raster, aligned to the GDAL block size of the first band
+
+        Parameters
+        ----------
+        img_file : str
+            file path to raster
+        window_size : int
+            approximate window width / height in pixels, rounded down to a multiple
+            of the block size (a window is never smaller than one block)
+        max_pixels : int
+            optional upper bound of the window area (rows are reduced for striped
+            rasters whose blocks span the full width)
+
+        Returns
+        -------
+        list
+            (xoff, yoff, xsize, ysize) tuples
+    """
+    with open_dataset(img_file) as src:
+        block_x, block_y = src.GetRasterBand(1).GetBlockSize()
+        x_size, y_size = src.RasterXSize, src.RasterYSize
+    step_x = max(block_x, (window_size // block_x) * block_x)
+    step_y = max(block_y, (window_size // block_y) * block_y)
+    if max_pixels and step_x * step_y > max_pixels:
+        step_y = max(block_y, ((max_pixels // step_x) // block_y) * block_y)
+    windows = []
+    for yoff in range(0, y_size, step_y):
+        for xoff in range(0, x_size, step_x):
+            windows.append((xoff, yoff, min(step_x, x_size - xoff), min(step_y, y_size - yoff)))
+    return(windows)
+
+
+def read_window(src, window, band_num=1):
+    xoff, yoff, xsize, ysize = window
+    return(src.GetRasterBand(band_num).ReadAsArray(xoff, yoff, xsize, ysize))
+
+
+def write_window(dataset_out, window, array, band_num=1):
+    xoff, yoff = window[0], window[1]
+    dataset_out.GetRasterBand(band_num).WriteArray(array, xoff, yoff)
+
+
+@traced
+def apply_mask_image(image, output_image, mask_image=None, window_size=1024):
+    """ Writes a masked copy of a raster, window by window
+
+        Rasters with a scale / offset (virtually calibrated, see scale_image) are
+        written as float32 values with the float32 precision, the scale is applied
+        to each window while it is copied.
+
+        Parameters
+        ----------
+        image : str
+            file path to input raster
+        output_image : str
+            full path to output GeoTIFF
+        mask_image : str
+            optional binary mask raster on the same grid (1 = keep)
+        window_size : int
+            approximate window width / height in pixels
+
+        Returns
+        -------
+        str
+            path to output image
+    """
+    print('WRITING IMAGE: ' + output_image)
+    band_meta = get_band_meta(image)
+    unscale = is_unscaled_output(band_meta)
+    out_meta = float_meta(band_meta) if unscale else band_meta
+    dataset_out = create_image(output_image, 'GTiff', out_meta, band_meta['band_num'])
+    datasets = ThreadDatasets()
+
+    def read(window):
+        mask = read_window(datasets.get(mask_image), window) if mask_image else None
+        return(mask, [read_window(datasets.get(image), window, band) for band in range(1, band_meta['band_num'] + 1)])
+
+    with AsyncWriter() as writer:
+        for window, (mask, arrays) in prefetch_windows(read, block_windows(image, window_size)):
+            for band, array in enumerate(arrays, 1):
+                if unscale:
+                    array = decode(array, band_meta)
+                    np.copyto(array, out_meta['nodata'], where=np.isnan(array))
+                if mask is not None:
+                    mask_array(mask, array, out_meta['nodata'])
+                writer.write(dataset_out, window, array, band)
+    datasets.close()
+    dataset_out = None
+    return(output_image)
+
+
+@traced
+def stack_images(image_list, out_name, band_names=None, window_size=1024):
+    """ Writes single band rasters to a multi-band raster, window by window
+
+        Memory depends on the window size and not on the number of bands.
+
+        Parameters
+        ----------
+        image_list : list
+            file paths to single band rasters on the same grid (band order)
+        out_name : str
+            full path to output GeoTIFF
+        band_names : list
+            optional band descriptions (i.e. B02, B03, ...)
+        window_size : int
+            approximate window width / height in pixels
+
+        Returns
+        -------
+        str
+            path to output image
+    """
+    print('WRITING IMAGE: ' + out_name)
+    band_meta = get_band_meta(image_list[0])
+    dataset_out = create_image(out_name, 'GTiff', band_meta, len(image_list))
+    for i, name in enumerate(band_names or []):
+        dataset_out.GetRasterBand(i + 1).SetDescription(name)
+    datasets = ThreadDatasets()
+
+    def read(window):
+        return([read_window(datasets.get(image), window) for image in image_list])
+
+    # the next windows are decoded while the current one is written
+    with AsyncWriter() as writer:
+        for window, arrays in prefetch_windows(read, block_windows(image_list[0], window_size)):
+            for i, array in enumerate(arrays):
+                writer.write(dataset_out, window, array, i + 1)
+    datasets.close()
     dataset_out = None
+    return(out_name)
+
+
+# memory available to the windowed multi-date operations (MB)
+MEMORY_BUDGET = 1024
+
+
+def set_memory_budget(megabytes):
+    """ Sets the memory budget (MB) of the windowed operations """
+    global MEMORY_BUDGET
+    MEMORY_BUDGET = megabytes
+
+
+def window_pixels(bytes_per_pixel, num_threads=1):
+    """ Largest window area (pixels) keeping num_threads windows within MEMORY_BUDGET """
+    return(max(1, int(MEMORY_BUDGET * 1024 ** 2 // (bytes_per_pixel * num_threads))))
+
+
+# read-only datasets opened once per thread (gdal datasets are not thread safe)
+class ThreadDatasets(object):
+
+    def __init__(self):
+
+        self.local = threading.local()
+        self.handles = []
+        self.lock = threading.Lock()
+
+    def get(self, image):
+        datasets = getattr(self.local, 'datasets', None)
+        if datasets is None:
+            datasets = self.local.datasets = {}
+        if image not in datasets:
+            datasets[image] = gdal.Open(image)
+            with self.lock:
+                self.handles.append(datasets[image])
+        return(datasets[image])
+
+    def close(self):
+        del self.handles[:]
+
+
+def map_windows(function, windows, num_threads=1):
+    """ Calls function(window) for every window on a pool of threads """
+    if num_threads <= 1:
+        for window in windows:
+            function(window)
+        return
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for _ in executor.map(function, windows):
+            pass
+
+
+# windows read ahead by the prefetching reader / queued by the asynchronous writer
+PREFETCH = 2
+
+
+def prefetch_windows(read, windows, depth=None):
+    """ Yields (window, read(window)) while the next windows are read on background threads
+
+        GDAL releases the GIL while decoding, so the next windows are decoded while
+        the current one is computed. read runs on the pool threads and must open its
+        datasets through ThreadDatasets.
+
+        Parameters
+        ----------
+        read : function
+            read(window) -> data of the window
+        windows : list
+            (xoff, yoff, xsize, ysize) tuples
+        depth : int
+            number of windows read ahead (default PREFETCH, 0 reads in the calling thread)
+    """
+    depth = PREFETCH if depth is None else depth
+    if depth < 1:
+        for window in windows:
+            yield((window, read(window)))
+        return
+    windows = iter(windows)
+    with ThreadPoolExecutor(max_workers=depth) as executor:
+        pending = deque((window, executor.submit(read, window)) for window in itertools.islice(windows, depth))
+        while pending:
+            window, future = pending.popleft()
+            for next_window in itertools.islice(windows, 1):
+                pending.append((next_window, executor.submit(read, next_window)))
+            yield((window, future.result()))
+
+
+# writes windows on a background thread in submission order - with AsyncWriter() as writer: ...
+class AsyncWriter(object):
+
+    def __init__(self, depth=None):
+
+        # bounded queue, write blocks when the writer falls behind
+        self.queue = queue.Queue(maxsize=max(1, PREFETCH if depth is None else depth))
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                try:
+                    write_window(*item)
+                except Exception as error:
+                    self.error = error
+
+    def write(self, dataset_out, window, array, band_num=1):
+        """ Queues a window, the array must not be modified afterwards """
+        if self.error is not None:
+            raise self.error
+        self.queue.put((dataset_out, window, array, band_num))
+
+    def close(self):
+        """ Waits until all queued windows are written """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc):
+        self.close()
+        return(False)
+
+
+def same_grid(band_meta, other_meta):
+    """ True if two rasters have the same size and geotransform """
+    return((band_meta['X'], band_meta['Y'], list(band_meta['geotransform'])) ==
+           (other_meta['X'], other_meta['Y'], list(other_meta['geotransform'])))
+
+
+def composite_method(method):
+    """ Validates a composite method: mean, median, max-ndvi or a percentile p0 - p100 (i.e. p90) """
+    if method in ('mean', 'median', 'max-ndvi'):
+        return(method)
+    if method.startswith('p') and method[1:].replace('.', '', 1).isdigit() and 0 <= float(method[1:]) <= 100:
+        return(method)
+    raise ValueError('unknown composite method: {}'.format(method))
+
+
+def nan_percentile(stack, q):
+    """ Percentile of the dates of every pixel, nan ignored (as np.nanpercentile, linear)
+
+        The dates are sorted once for all pixels (nan last) and the two dates around the
+        rank of the percentile are interpolated, instead of a per pixel nanpercentile.
+
+        Parameters
+        ----------
+        stack : numpy array
+            (dates, rows, cols) float32 values, nodata as nan
+        q : float
+            percentile (0 - 100)
+
+        Returns
+        -------
+        numpy array
+            (rows, cols) float32 percentile, nan for pixels without any valid date
+    """
+    ordered = np.sort(stack, axis=0)
+    valid = np.sum(~np.isnan(stack), axis=0)
+    rank = np.maximum(valid - 1, 0) * (float(q) / 100.)
+    lower = np.floor(rank).astype(np.intp)
+    upper = np.ceil(rank).astype(np.intp)
+    low = np.take_along_axis(ordered, lower[np.newaxis], axis=0)[0]
+    high = np.take_along_axis(ordered, upper[np.newaxis], axis=0)[0]
+    weight = (rank - lower).astype(np.float32)
+    result = np.subtract(high, low, dtype=np.float32)
+    result *= weight
+    result += low
+    result[valid == 0] = np.nan
+    return(result)
+
+
+def read_dates(sources, window, band, band_meta):
+    """ Window of a band for every date as a (dates, rows, cols) float32 array, nodata as nan """
+    stack = np.empty((len(sources), window[3], window[2]), dtype=np.float32)
+    for i, src in enumerate(sources):
+        data = read_window(src, window, band)
+        stack[i] = decode(data, band_meta)
+        stack[i][data == band_meta['nodata']] = np.nan
+    return(stack)
+
+
+# dates of a composite read from co-registered rasters, one per date (see datacube.CubeDates
+# for dates read from the datacube)
+class DateRasters(object):
+
+    def __init__(self, image_list, band_meta=None):
+
+        self.image_list = image_list
+        self.band_meta = band_meta or get_band_meta(image_list[0])
+        self.datasets = ThreadDatasets()
+
+    def __len__(self):
+        return(len(self.image_list))
+
+    def windows(self, window_size=1024, max_pixels=None):
+        return(block_windows(self.image_list[0], window_size, max_pixels))
+
+    def read(self, window, band):
+        return(read_dates([self.datasets.get(image) for image in self.image_list], window, band, self.band_meta))
+
+    def close(self):
+        self.datasets.close()
+
+
+@traced
+def composite_images(image_list, out_images, band_meta, ndvi_list=None, num_threads=None):
+    """ Per pixel composites (nodata / nan ignored) of co-registered rasters
+
+        Windows are processed in parallel, their size is chosen so that all threads
+        together stay within MEMORY_BUDGET whatever the number of dates.
+
+        Parameters
+        ----------
+        image_list : list or DateRasters
+            file paths to rasters with the same grid and band count (one per date),
+            or the dates of a datacube variable (datacube.CubeDates)
+        out_images : dict
+            composite method (mean, median, pNN, max-ndvi) -> full path to output file
+        band_meta : dict
+            metadata (coordinate system, transform, dtype / scale) of the input rasters,
+            also used for the outputs
+        ndvi_list : list or DateRasters
+            ndvi rasters of the same dates (same order), required by max-ndvi - the
+            values of the date with the highest ndvi (greenest pixel) are kept
+        num_threads : int
+            number of windows processed at the same time (default: number of cores)
+
+        Returns
+        -------
+        dict
+            composite method -> full path to output file
+    """
+    methods = [composite_method(method) for method in out_images.keys()]
+    if 'max-ndvi' in methods and not ndvi_list:
+        raise ValueError('max-ndvi composites need the ndvi images of the dates')
+    num_threads = num_threads or os.cpu_count() or 1
+    band_num = band_meta['band_num']
+    # per pixel: the dates of a band (float32), the temporaries of the percentile sort / mean and
+    # the ndvi dates with the selected date
+    # readers created here are closed here
+    dates = image_list if hasattr(image_list, 'read') else DateRasters(image_list, band_meta)
+    ndvi_dates = ndvi_list if ndvi_list is None or hasattr(ndvi_list, 'read') else DateRasters(ndvi_list)
+    if ndvi_dates is not None and not same_grid(ndvi_dates.band_meta, dates.band_meta):
+        raise ValueError('max-ndvi composites need the ndvi images on the grid of the dates')
+    bytes_per_pixel = len(dates) * 4 * (3 + (2 if 'max-ndvi' in methods else 0))
+    max_pixels = window_pixels(bytes_per_pixel, num_threads)
+    windows = dates.windows(int(max_pixels ** 0.5), max_pixels)
+    # a window is at least a block (chunk), fewer threads keep the windows within the budget
+    # (and fewer dataset handles: one per thread and date)
+    window_bytes = max(window[2] * window[3] for window in windows) * bytes_per_pixel
+    num_threads = max(1, min(num_threads, int(MEMORY_BUDGET * 1024 ** 2 // window_bytes)))
+
+    outputs = {}
+    for method in methods:
+        print('WRITING IMAGE: ' + out_images[method])
+        outputs[method] = create_image(out_images[method], 'GTiff', band_meta, band_num)
+    writer = AsyncWriter(num_threads)
+
+    def composite_window(window):
+        greenest = None
+        if 'max-ndvi' in methods:
+            ndvi = ndvi_dates.read(window, 1)
+            np.copyto(ndvi, -np.inf, where=np.isnan(ndvi))
+            greenest = np.argmax(ndvi, axis=0)[np.newaxis]
+            ndvi = None
+        for band in range(1, band_num + 1):
+            stack = dates.read(window, band)
+            for method in methods:
+                if method == 'mean':
+                    result = np.nanmean(stack, axis=0)
+                elif method == 'median':
+                    result = np.nanmedian(stack, axis=0)
+                elif method == 'max-ndvi':
+                    result = np.take_along_axis(stack, greenest, axis=0)[0]
+                else:
+                    result = nan_percentile(stack, float(method[1:]))
+                # pixels without any valid date are written as nodata (by encode for scaled products)
+                if not band_meta.get('scale'):
+                    np.copyto(result, band_meta['nodata'], where=np.isnan(result))
+                writer.write(outputs[method], window, encode(result, band_meta), band)
+            stack = None
+
+    try:
+        map_windows(composite_window, windows, num_threads)
+    finally:
+        writer.close()
+    if dates is not image_list:
+        dates.close()
+    if ndvi_dates is not ndvi_list:
+        ndvi_dates.close()
+    outputs = None
+    for method in methods:
+        finalize_image(out_images[method])
+    return(out_images)
 
 
 # masking operations
+def mask_lut(pixel_values):
+    """ Compiles the pixel values to keep into a 256 entry lookup table (1 = keep)
+
+        Parameters
+        ----------
+        pixel_values : list
+            list of values in scl / fmask to keep
+
+        Returns
+        -------
+        numpy array
+            uint8 lookup table indexed by pixel value
+    """
+    lut = np.zeros(256, dtype=np.uint8)
+    lut[list(pixel_values)] = 1
+    return(lut)
+
+
+@traced
 def binary_mask(scl, pixel_values):
     """ Binary mask
 
@@ -201,18 +1315,31 @@ def binary_mask(scl, pixel_values):
             Land use land cover (LULC) array
         pixel_values : list
             list of values in scl to keep
+
+        Returns
+        -------
+        numpy array
+            uint8 mask, 1 where scl is one of pixel_values
     """
-    mask = np.zeros(scl.shape)
-    for pixel_value in pixel_values:
-        mask = np.ma.masked_where(scl == pixel_value, mask).filled(1)
-    return(mask)
+    return(mask_values(scl, pixel_values))
+
+
+def mask_values(scl, pixel_values):
+    # binary_mask of a window (not traced)
+    if scl.dtype == np.uint8:
+        # single indexing pass through the lookup table
+        return(mask_lut(pixel_values)[scl])
+    return(np.isin(scl, list(pixel_values)).astype(np.uint8))
 
 
-def mask_array(mask, array):
-    return(np.ma.masked_where(mask == 0, array).filled(0))
+def mask_array(mask, array, nodata=0):
+    """ Sets the pixels of array outside the mask to nodata, in place """
+    np.copyto(array, nodata, where=(mask == 0))
+    return(array)
 
 
 # spectral index calculations
+@traced
 def normalized_diff(b1, b2):
     """ Normalized Difference Index (NDVI, NWDI, etc...)
 
@@ -222,29 +1349,23 @@ def normalized_diff(b1, b2):
 
         Parameters:
         -----------
-        b1 , b2 : numpy array
+        b1 , b2 : str
+            file path to bands
 
         Returns:
         --------
         numpy array
-            normalized difference raster
+            normalized difference raster (float32, nan where invalid)
     """
 
-    b1, b2 = read_band(b1) / float(10000), read_band(b2) / float(10000)
+    b1, b2 = reflectance(read_band(b1)), reflectance(read_band(b2))
     if not (b1.shape == b2.shape):
         raise ValueError("Both arrays should have the same dimensions")
 
-    # Ignore warning for division by zero
-    with np.errstate(divide="ignore"):
-        n_diff = (b1 - b2) / (b1 + b2).astype(np.float32)
-        # mask out invalid values
-        n_diff[np.isinf(n_diff)] = np.nan
-        if np.isnan(n_diff).any():
-            n_diff = np.ma.masked_invalid(n_diff)
-
-    return n_diff
+    return compile_index('(B08 - B04) / (B08 + B04)')({'B08': b1, 'B04': b2})
 
 
+@traced
 def vdvi(blue, green, red):
     """ Visible Difference Vegetation Index (Wang et al 2005)
 
@@ -254,7 +1375,8 @@ def vdvi(blue, green, red):
 
         Parameters:
         -----------
-        red, green, blue : numpy array
+        red, green, blue : str
+            file path to bands
 
         Returns:
         --------
@@ -263,17 +1385,10 @@ def vdvi(blue, green, red):
     """
     b1, b2, b3 = read_band(blue), read_band(green), read_band(red)
 
-    # ignore warning for division by zero
-    with np.errstate(divide="ignore"):
-        vdvi = ((2*b2) - b3 - b1) / ((2*b2) + b3 + b1).astype(np.float32)
-        # mask out invalid values
-        vdvi[np.isinf(vdvi)] = np.nan
-        if np.isnan(vdvi).any():
-            vdvi = np.ma.masked_invalid(vdvi)
-
-    return vdvi
+    return compile_index('(2 * B03 - B04 - B02) / (2 * B03 + B04 + B02)')({'B02': reflectance(b1), 'B03': reflectance(b2), 'B04': reflectance(b3)})
 
 
+@traced
 def bare_soil(blue, red, nir, swir):
     """ Bare Soil Index
 
@@ -283,27 +1398,21 @@ def bare_soil(blue, red, nir, swir):
 
         Parameters:
         -----------
-        blue, red, nir, swir : numpy array
+        blue, red, nir, swir : str
+            file path to bands
 
         Returns:
         --------
         numpy array
             BSI
     """
-    b2, b4, b8, b11 = read_band(blue) / float(10000), read_band(red) / float(10000), read_band(nir) / float(10000), read_band(swir) / float(10000)
+    b2, b4, b8, b11 = reflectance(read_band(blue)), reflectance(read_band(red)), reflectance(read_band(nir)), reflectance(read_band(swir))
     if not (b2.shape == b4.shape == b8.shape == b11.shape):
         raise ValueError("Both arrays should have the same dimensions")
 
-    # Ignore warning for division by zero
-    with np.errstate(divide="ignore"):
-        bsi = ((b11 + b4) - (b8 + b2)) / ((b11 + b4) + (b8 + b2)).astype(np.float32)
-        # mask out invalid values
-        bsi[np.isinf(bsi)] = np.nan
-        if np.isnan(bsi).any():
-            bsi = np.ma.masked_invalid(bsi)
-
-    return bsi
+    return compile_index('((B11 + B04) - (B08 + B02)) / ((B11 + B04) + (B08 + B02))')({'B02': b2, 'B04': b4, 'B08': b8, 'B11': b11})
 
+@traced
 def bsi_2(blue, red, nir, swir):
     """ (New?) Bare Soil Index (https://medium.com/sentinel-hub/area-monitoring-bare-soil-marker-608bc95712ae)
 
@@ -313,7 +1422,8 @@ def bsi_2(blue, red, nir, swir):
 
         Parameters:
         -----------
-        blue, red, nir, swir : numpy array
+        blue, red, nir, swir : str
+            file path to bands
 
         Returns:
         --------
@@ -322,15 +1432,227 @@ def bsi_2(blue, red, nir, swir):
     """
 
 
-    blue_arr, red_arr, nir_arr, swir_arr = read_band(blue), read_band(red), read_band(nir), read_band(swir)
-    with np.errstate(divide="ignore"):
-        bsi_2 = ((swir_arr - red_arr) / (nir_arr + blue_arr))
+    blue_arr, red_arr, nir_arr, swir_arr = reflectance(read_band(blue)), reflectance(read_band(red)), reflectance(read_band(nir)), reflectance(read_band(swir))
+
+    return compile_index('(B11 - B04) / (B08 + B02)')({'B02': blue_arr, 'B04': red_arr, 'B08': nir_arr, 'B11': swir_arr})
+
+
+# band expression of each derived index - compiled to fused float32 kernels (expressions.py),
+# indices defined in the configuration (vi-expressions) are added with register_indices
+VI_EXPRESSIONS = {
+                  'ndvi': '(B08 - B04) / (B08 + B04)',
+                  'ndmi': '(B08 - B11) / (B08 + B11)',
+                  'ndti': '(B11 - B12) / (B11 + B12)',
+                  'crc': '(B11 - B02) / (B11 + B02)',
+                  'vdvi': '(2 * B03 - B04 - B02) / (2 * B03 + B04 + B02)',
+                  'bsi': '((B11 + B04) - (B08 + B02)) / ((B11 + B04) + (B08 + B02))'
+                  }
+# built-in indices can not be redefined by the configuration
+BUILTIN_INDICES = frozenset(VI_EXPRESSIONS)
+
+# compiled kernel and bands of each derived index
+VI_KERNELS = {}
+VI_BANDS = {}
+
+
+def register_indices(expressions, builtin=False):
+    """ Compiles derived indices from band expressions
+
+        Parameters
+        ----------
+        expressions : dict
+            index name -> band expression, i.e. {'evi2': '2.5 * (B08 - B04) / (B08 + 2.4 * B04 + 1)'},
+            raises ValueError for invalid names / expressions
+        builtin : bool
+            registration of the built-in indices, other expressions may not use their names
+    """
+    expressions = dict(expressions)
+    shadowing = sorted(name for name in expressions if name in BUILTIN_INDICES)
+    if shadowing and not builtin:
+        raise ValueError('index expressions redefine built-in indices: {}'.format(', '.join(shadowing)))
+    for name, expression in expressions.items():
+        VI_KERNELS[name] = IndexKernel(name, str(expression))
+        VI_BANDS[name] = VI_KERNELS[name].bands
+        VI_EXPRESSIONS[name] = str(expression)
+
+
+register_indices(VI_EXPRESSIONS, builtin=True)
+
+
+def index_bands(indices):
+    """ Union of the bands needed by a list of derived indices (sorted) """
+    return(sorted(set(band for index in indices for band in VI_BANDS[index])))
+
+
+# preallocated float32 window buffers handed out round robin (i.e. for the index windows) -
+# a buffer is reused only once the AsyncWriter (queue of depth windows) has written it
+class WindowBuffers(object):
+
+    def __init__(self, windows, depth=None):
+
+        size = max([window[2] * window[3] for window in windows] or [0])
+        # queued windows, the window being written and the one being computed
+        count = (PREFETCH if depth is None else depth) + 3
+        self.buffers = [np.empty(size, dtype=np.float32) for _ in range(count)]
+        self.position = 0
+
+    def get(self, window):
+        buffer = self.buffers[self.position]
+        self.position = (self.position + 1) % len(self.buffers)
+        return(buffer[:window[2] * window[3]].reshape(window[3], window[2]))
+
+
+@traced
+def derive_indices(indices, band_pathes, index_images, band_meta, window_size=1024):
+    """ Derives several spectral indices in a single pass over the input bands
+
+        Each band needed by at least one index is decoded once per window and the
+        decoded window is shared by every index using it.
+
+        Parameters
+        ----------
+        indices : list
+            derived indices to calculate (keys of VI_BANDS)
+        band_pathes : dict
+            band name -> file path, all bands on the same grid
+        index_images : dict
+            index name -> full path to output file
+        band_meta : dict
+            output raster metadata (coordinate system, transform, cell size, etc...)
+        window_size : int
+            approximate window width / height in pixels
+
+        Returns
+        -------
+        dict
+            index name -> full path to output file
+    """
+    bands = index_bands(indices)
+    windows = block_windows(band_pathes[bands[0]], window_size)
+
+    index_meta = float_meta(band_meta)
+    outputs = {}
+    for index in indices:
+        print('WRITING IMAGE: ' + index_images[index])
+        outputs[index] = create_image(index_images[index], 'GTiff', index_meta, 1)
+
+    datasets = ThreadDatasets()
+    buffers = WindowBuffers(windows)
+
+    def read(window):
+        return(dict((band, reflectance(read_window(datasets.get(band_pathes[band]), window))) for band in bands))
 
-    bsi_2[np.isinf(bsi_2)] = np.nan
-    if np.isnan(bsi_2).any():
-        bsi_2 = np.ma.masked_invalid(bsi_2)
+    # bands of the next windows are decoded, finished index windows written in the background
+    with AsyncWriter() as writer:
+        for window, arrays in prefetch_windows(read, windows):
+            for index in indices:
+                writer.write(outputs[index], window, encode(VI_KERNELS[index](arrays, buffers.get(window)), index_meta))
 
-    return bsi_2
+    datasets.close()
+    outputs = None
+    return(index_images)
+
+
+@traced
+def write_tile_windowed(band_pathes, outputs, indices=(), index_pathes=None, mask_layers=(), stack=False):
+    """ Writes all outputs of a tile in a single windowed pass
+
+        For every block aligned window the needed bands are read once, the combined
+        cloud mask is built from the mask layers and applied, the indices are derived
+        (and calibrated bands unscaled) and the window is written to every output
+        before the next one is read. The window size keeps the pass within
+        MEMORY_BUDGET.
+
+        Parameters
+        ----------
+        band_pathes : list
+            (band name, file path) of the output bands on the target grid, in band order
+        outputs : dict
+            output name ('stacked', band name or index name) -> full path to output file
+        indices : list
+            derived indices to calculate (keys of VI_KERNELS)
+        index_pathes : dict
+            band name -> file path of the bands needed by the indices (target grid)
+        mask_layers : list
+            (file path, pixel values to keep) of the cloud mask rasters (target grid),
+            a pixel is kept only if it is clear in all of them
+        stack : bool
+            write the bands to a single multi-band output (outputs['stacked'])
+
+        Returns
+        -------
+        dict
+            output name -> full path to output file
+    """
+    index_pathes = index_pathes or {}
+    # a band both written and used by an index (same grid node) is read once per window
+    band_images = list(dict.fromkeys([path for _, path in band_pathes] + list(index_pathes.values())))
+    images = band_images + [path for path, _ in mask_layers]
+
+    # per pixel: bands read, reflectance of the index bands, index windows and masks (float32 /
+    # uint8), for the current window and the windows read ahead / queued for writing
+    bytes_per_pixel = 4 * (len(band_images) + len(index_pathes) + len(indices)) + 2 * len(mask_layers) + 8
+    max_pixels = window_pixels(bytes_per_pixel, PREFETCH + 2)
+    windows = block_windows(images[0], int(max_pixels ** 0.5), max_pixels)
+
+    # calibrated (scaled) bands are unscaled to float32 with the float32 precision
+    band_meta = get_band_meta(band_pathes[0][1])
+    unscale = is_unscaled_output(band_meta)
+    out_meta = float_meta(band_meta) if unscale else band_meta
+    datasets = {}
+    if stack:
+        print('WRITING IMAGE: ' + outputs['stacked'])
+        datasets['stacked'] = create_image(outputs['stacked'], 'GTiff', out_meta, len(band_pathes))
+        for i, (name, _) in enumerate(band_pathes):
+            datasets['stacked'].GetRasterBand(i + 1).SetDescription(name)
+    else:
+        for name, _ in band_pathes:
+            print('WRITING IMAGE: ' + outputs[name])
+            datasets[name] = create_image(outputs[name], 'GTiff', out_meta, 1)
+    index_meta = float_meta(get_band_meta(list(index_pathes.values())[0])) if indices else None
+    for index in indices:
+        print('WRITING IMAGE: ' + outputs[index])
+        datasets[index] = create_image(outputs[index], 'GTiff', index_meta, 1)
+
+    sources = ThreadDatasets()
+    buffers = WindowBuffers(windows)
+
+    def read(window):
+        # masks are combined and index bands converted to reflectance on the reading threads
+        mask = None
+        for path, pixel_values in mask_layers:
+            layer = mask_values(read_window(sources.get(path), window), pixel_values)
+            mask = layer if mask is None else np.multiply(mask, layer, out=mask)
+        data = dict((path, read_window(sources.get(path), window)) for path in band_images)
+        # reflectance is computed before the output bands are masked in place
+        arrays = dict((band, reflectance(data[path])) for band, path in index_pathes.items())
+        return(mask, [data[path] for _, path in band_pathes], arrays)
+
+    with AsyncWriter() as writer:
+        for window, (mask, bands, arrays) in prefetch_windows(read, windows):
+            for i, (name, _) in enumerate(band_pathes):
+                array = bands[i]
+                if unscale:
+                    array = decode(array, band_meta)
+                    np.copyto(array, out_meta['nodata'], where=np.isnan(array))
+                if mask is not None:
+                    mask_array(mask, array, out_meta['nodata'])
+                if stack:
+                    writer.write(datasets['stacked'], window, array, i + 1)
+                else:
+                    writer.write(datasets[name], window, array)
+
+            for index in indices:
+                array = encode(VI_KERNELS[index](arrays, buffers.get(window)), index_meta)
+                if mask is not None:
+                    mask_array(mask, array, index_meta['nodata'])
+                writer.write(datasets[index], window, array)
+
+    sources.close()
+    datasets = None
+    for output_image in outputs.values():
+        finalize_image(output_image)
+    return(outputs)
 
 
 # vector operations
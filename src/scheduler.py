@@ -0,0 +1,168 @@
+import os
+import threading
+import subprocess
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from metrics import traced
+
+# cores / memory (MB) used by one instance of an external tool on a full 10980 x 10980 tile
+TOOL_RESOURCES = {'L2A_Process': {'cpus': 1, 'memory-mb': 4096},
+                  'fmask_sentinel2Stacked.py': {'cpus': 1, 'memory-mb': 3072}}
+
+
+class ToolError(Exception):
+    """ External tool (Sen2Cor / Fmask) exited with a non zero return code """
+
+    def __init__(self, command, return_code, log_file):
+        self.command = command
+        self.return_code = return_code
+        self.log_file = log_file
+        message = '{} failed with return code {} (log: {})'.format(command[0], return_code, log_file)
+        tail = log_tail(log_file)
+        if tail:
+            message += '\n' + tail
+        super(ToolError, self).__init__(message)
+
+
+def log_tail(log_file, lines=10):
+    try:
+        with open(log_file, 'r', errors='replace') as stream:
+            return(''.join(stream.readlines()[-lines:]).rstrip())
+    except (IOError, OSError):
+        return('')
+
+
+def available_memory_mb():
+    """ Memory available for new processes (MemAvailable of /proc/meminfo), None if unknown """
+    try:
+        with open('/proc/meminfo') as stream:
+            for line in stream:
+                if line.startswith('MemAvailable:'):
+                    return(int(line.split()[1]) / 1024.)
+    except (IOError, OSError):
+        pass
+    return(None)
+
+
+def tool_limits(limits=None):
+    """ Number of concurrent instances of each external tool
+
+        Parameters
+        ----------
+        limits : dict
+            optional fixed limits by tool, i.e. {'L2A_Process': 2}, tools without
+            (or with a None) limit are capped by the available cores and memory
+
+        Returns
+        -------
+        dict
+            concurrent instances by tool (at least 1)
+    """
+    cpus = os.cpu_count() or 1
+    memory = available_memory_mb()
+    tool_jobs = {}
+    for tool, resources in TOOL_RESOURCES.items():
+        if limits and limits.get(tool):
+            tool_jobs[tool] = limits[tool]
+            continue
+        jobs = cpus // resources['cpus']
+        if memory is not None:
+            jobs = min(jobs, int(memory // resources['memory-mb']))
+        tool_jobs[tool] = max(1, jobs)
+    return(tool_jobs)
+
+
+@traced
+def run_tool(command, log_file):
+    """ Runs an external tool, stdout / stderr are written to log_file, returns the return code """
+    with open(log_file, 'w') as log:
+        log.write(' '.join(command) + '\n')
+        log.flush()
+        return(subprocess.call(command, stdout=log, stderr=subprocess.STDOUT))
+
+
+# runs Sen2Cor / Fmask in the background so a tile can resample and derive indices while they run
+class ToolScheduler(object):
+
+    def __init__(self, log_dir, limits=None, queue_size=4):
+        """ Created before the tile workers are forked, the per tool semaphores are shared
+            by all workers so the limits hold for the whole run
+
+            Parameters
+            ----------
+            log_dir : str
+                directory of the per tile tool logs
+            limits : dict
+                optional fixed number of concurrent instances by tool
+            queue_size : int
+                jobs of a process queued or running at the same time, submit blocks
+                when the queue is full
+        """
+        self.log_dir = log_dir
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+        self.limits = tool_limits(limits)
+        context = multiprocessing.get_context('fork')
+        self.semaphores = dict((tool, context.BoundedSemaphore(jobs)) for tool, jobs in self.limits.items())
+        self.queue_size = queue_size
+        self.pid = None
+        self.executor = None
+        self.queue = None
+        print('EXTERNAL TOOL LIMITS: {}'.format(self.limits))
+
+    def _start(self):
+        # threads are not inherited by forked workers, each process starts its own executor
+        if self.executor is None or self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.executor = ThreadPoolExecutor(max_workers=self.queue_size)
+            self.queue = threading.BoundedSemaphore(self.queue_size)
+
+    def log_file(self, tile_name, command):
+        tile = os.path.splitext(os.path.split(os.path.normpath(tile_name))[1])[0]
+        tool = os.path.splitext(os.path.split(command[0])[1])[0]
+        return(self.log_dir + os.sep + '_'.join([tile, tool]) + '.log')
+
+    def submit(self, command, tile_name):
+        """ Queues an external tool job
+
+            Parameters
+            ----------
+            command : list
+                command line, the first element is the tool
+            tile_name : str
+                tile (SAFE name or path) the job belongs to, names the log file
+
+            Returns
+            -------
+            Future
+                result() waits for the job and raises ToolError if it failed
+        """
+        self._start()
+        log_file = self.log_file(tile_name, command)
+        print('QUEUING {} (log: {})'.format(' '.join(command), log_file))
+        self.queue.acquire()
+        try:
+            return(self.executor.submit(self._run, command, log_file))
+        except Exception:
+            self.queue.release()
+            raise
+
+    def run(self, command, tile_name):
+        """ Runs an external tool job and waits for it """
+        return(self.submit(command, tile_name).result())
+
+    def _run(self, command, log_file):
+        semaphore = self.semaphores.get(os.path.split(command[0])[1])
+        try:
+            if semaphore is not None:
+                semaphore.acquire()
+            try:
+                return_code = run_tool(command, log_file)
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
+            if return_code:
+                raise ToolError(command, return_code, log_file)
+            return(log_file)
+        finally:
+            self.queue.release()
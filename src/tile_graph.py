@@ -0,0 +1,105 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import metrics
+
+# threads running the nodes of a tile (nodes also start gdal / external tool subprocesses)
+TILE_THREADS = min(4, os.cpu_count() or 1)
+
+
+# operations of a tile (decode, resample, mask, index, warp, stack, write) as a graph of nodes -
+# a node is keyed by its operation and parameters so a node requested twice (i.e. a band
+# resampled for the outputs and for an index) is computed once, and it runs on a thread pool
+# as soon as its inputs are ready, every node is recorded as an event of the tile timing report
+# (named by its operation)
+class TileGraph(object):
+
+    def __init__(self, num_threads=None):
+
+        self.executor = ThreadPoolExecutor(max_workers=num_threads or TILE_THREADS)
+        self.nodes = {}
+        self.lock = threading.Lock()
+
+    def node(self, key, function, *args, after=()):
+        """ Adds a node computing function(*args), or returns the node already added with key
+
+            Parameters
+            ----------
+            key : tuple
+                operation and parameters identifying the node
+            function : function
+                operation, called with the results of the args that are nodes (futures)
+            args :
+                arguments, nodes are replaced by their results
+            after : tuple
+                futures (nodes, external tool jobs) to wait for, their results are not passed
+
+            Returns
+            -------
+            Future
+                result of the node, raises the exception of the node or of a failed input
+        """
+        with self.lock:
+            if key in self.nodes:
+                return(self.nodes[key])
+            future = Future()
+            self.nodes[key] = future
+
+        inputs = [arg for arg in args if isinstance(arg, Future)] + list(after)
+        remaining = [len(inputs)]
+        remaining_lock = threading.Lock()
+
+        def run():
+            before = metrics.snapshot('thread') if metrics.tracing() and key[0] != 'gather' else None
+            result, failure = None, None
+            try:
+                result = function(*[arg.result() if isinstance(arg, Future) else arg for arg in args])
+            except Exception as error:
+                failure = error
+            # recorded before the result is set, the report is written once the outputs are done
+            if before is not None:
+                metrics.record('node', key[0], before, metrics.snapshot('thread'), ' '.join(str(part) for part in key[1:]) or None)
+            if failure is not None:
+                future.set_exception(failure)
+            else:
+                future.set_result(result)
+
+        def input_done(input_future):
+            if input_future.exception() is not None:
+                # a failed input fails the node (once)
+                with remaining_lock:
+                    failed = remaining[0] > 0
+                    remaining[0] = 0
+                if failed:
+                    future.set_exception(input_future.exception())
+                return
+            with remaining_lock:
+                remaining[0] -= 1
+                ready = remaining[0] == 0
+            if ready:
+                submit()
+
+        def submit():
+            try:
+                self.executor.submit(run)
+            except RuntimeError as error:
+                # graph closed after a failure, the node is not run
+                future.set_exception(error)
+
+        if not inputs:
+            submit()
+        for input_future in inputs:
+            input_future.add_done_callback(input_done)
+        return(future)
+
+    def gather(self, futures):
+        """ Node of the results of a list / dict of nodes (same structure) """
+        if isinstance(futures, dict):
+            keys = list(futures.keys())
+            return(self.node(('gather', tuple(keys)) + tuple(id(futures[key]) for key in keys),
+                             lambda *results: dict(zip(keys, results)), *[futures[key] for key in keys]))
+        return(self.node(('gather',) + tuple(id(future) for future in futures), lambda *results: list(results), *futures))
+
+    def close(self):
+        """ Waits for the running nodes """
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of src are imported as top level modules (as by the scripts in src)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, 'src'))
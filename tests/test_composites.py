@@ -0,0 +1,28 @@
+import warnings
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('osgeo')
+import raster_mod as rm
+
+
+def date_stack():
+    stack = np.random.RandomState(0).uniform(-1, 1, (7, 16, 16)).astype(np.float32)
+    # dates without data, a pixel with a single date and a pixel without any date
+    stack[np.random.RandomState(1).uniform(size=stack.shape) < 0.3] = np.nan
+    stack[1:, 0, 0] = np.nan
+    stack[:, 0, 1] = np.nan
+    return(stack)
+
+
+@pytest.mark.parametrize('q', [0, 10, 25, 50, 62.5, 90, 100])
+def test_nan_percentile_matches_nanpercentile(q):
+    stack = date_stack()
+    with warnings.catch_warnings():
+        # all-nan pixel
+        warnings.simplefilter('ignore', RuntimeWarning)
+        expected = np.nanpercentile(stack, q, axis=0)
+    result = rm.nan_percentile(stack, q)
+    assert result.dtype == np.float32
+    assert np.isnan(result[0, 1])
+    np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-6, equal_nan=True)
@@ -0,0 +1,56 @@
+import os
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('zarr')
+gdal = pytest.importorskip('osgeo.gdal')
+from osgeo import osr
+import raster_mod as rm
+from datacube import Datacube
+
+PRODUCTS = ['S2A_MSIL2A_20190521T235251_N0212_R130_T56HLH_20190522T011426.SAFE',
+            'S2B_MSIL2A_20190506T235259_N0212_R130_T56HLH_20190507T011312.SAFE',
+            'S2A_MSIL2A_20190531T235251_N0212_R130_T56HLH_20190601T011535.SAFE',
+            'S2B_MSIL2A_20190516T235259_N0212_R130_T56HLH_20190517T011410.SAFE']
+
+
+def write_output(path, value):
+    dataset = gdal.GetDriverByName('GTiff').Create(path, 9, 10, 2, gdal.GDT_Int16)
+    dataset.SetGeoTransform([300000., 10., 0., 6000000., 0., -10.])
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32756)
+    dataset.SetProjection(srs.ExportToWkt())
+    for band in (1, 2):
+        dataset.GetRasterBand(band).Fill(value)
+    dataset = None
+    return(path)
+
+
+def test_dates_appended_out_of_order(tmpdir):
+    cube = Datacube(str(tmpdir.join('cube.zarr')), {'y': 4, 'x': 4})
+    for value, product in enumerate(PRODUCTS, 1):
+        image = write_output(os.path.join(str(tmpdir), product[:-5] + '_stacked.tif'), value)
+        cube.append_tile(product, [image], num_threads=2)
+        rm.clear_cache()
+
+    group = cube.root['T56HLH']
+    # dates in arrival order, 'order' lists them by sensing time
+    assert group.attrs['products'] == PRODUCTS
+    assert group.attrs['time'] == [product[11:26] for product in PRODUCTS]
+    assert [group.attrs['time'][date] for date in group.attrs['order']] == sorted(product[11:26] for product in PRODUCTS)
+    stacked = group['stacked']
+    assert stacked.shape == (4, 2, 10, 9)
+    # each date holds the values of its product (1 - 4 in the order of PRODUCTS)
+    for date, product in enumerate(group.attrs['products']):
+        assert (stacked[date] == PRODUCTS.index(product) + 1).all()
+
+    # a date rewritten in place keeps its slot
+    cube.append_tile(PRODUCTS[1], [write_output(os.path.join(str(tmpdir), PRODUCTS[1][:-5] + '_stacked.tif'), 7)])
+    group = cube.root['T56HLH']
+    assert group.attrs['products'] == PRODUCTS
+    assert (group['stacked'][1] == 7).all()
+
+    dates = cube.date_stacks(PRODUCTS[:2])['stacked']
+    stack = dates.read((0, 0, 9, 10), 1)
+    assert stack.shape == (2, 10, 9)
+    assert (stack[0] == 1).all() and (stack[1] == 7).all()
@@ -0,0 +1,88 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+import expressions
+from expressions import IndexKernel, compile_index
+
+
+@pytest.fixture(params=['numexpr', 'numpy'])
+def backend(request, monkeypatch):
+    if request.param == 'numexpr':
+        if expressions.numexpr is None:
+            pytest.skip('numexpr is not installed')
+    else:
+        monkeypatch.setattr(expressions, 'numexpr', None)
+        # several blocks on several threads
+        monkeypatch.setattr(expressions, 'BLOCK_SIZE', 7)
+        monkeypatch.setattr(expressions, 'KERNEL_THREADS', 3)
+    return(request.param)
+
+
+def bands(*names):
+    random = np.random.RandomState(0)
+    return(dict((name, random.uniform(0.01, 1, (5, 9)).astype(np.float32)) for name in names))
+
+
+def test_parse():
+    kernel = IndexKernel('evi2', '2.5 * (B08 - B04) / (B08 + 2.4 * B04 + 1)')
+    assert kernel.bands == ['B04', 'B08']
+    assert 'where(' in kernel.source
+    assert compile_index('(B08 - B04) / (B08 + B04)') is compile_index('(B08 - B04) / (B08 + B04)')
+
+
+@pytest.mark.parametrize('name, expression', [
+    ('ndvi', '(B08 - B13) / (B08 + B04)'),
+    ('ndvi', '(B08 - B04) / (B08 + NIR)'),
+    ('ndvi', 'B08 % B04'),
+    ('ndvi', 'max(B08, B04)'),
+    ('ndvi', '__import__("os")'),
+    ('ndvi', '(B08 - B04'),
+    ('ndvi', '2 * 3'),
+    ('nd_vi', '(B08 - B04) / (B08 + B04)'),
+    ('', '(B08 - B04) / (B08 + B04)'),
+])
+def test_reject(name, expression):
+    with pytest.raises(ValueError):
+        IndexKernel(name, expression)
+
+
+def test_values(backend):
+    arrays = bands('B02', 'B04', 'B08')
+    kernel = IndexKernel('test', 'sqrt(abs(B08 - B04)) / (B08 + B04) - 2 * B02 ** 2 + log(B08)')
+    b02, b04, b08 = arrays['B02'], arrays['B04'], arrays['B08']
+    expected = np.sqrt(np.abs(b08 - b04)) / (b08 + b04) - 2 * b02 ** 2 + np.log(b08)
+    out = np.empty(b02.shape, dtype=np.float32)
+    result = kernel(arrays, out)
+    assert result is out and result.dtype == np.float32
+    np.testing.assert_allclose(result, expected, rtol=1e-5)
+
+
+def test_divide_by_zero_is_nan(backend):
+    arrays = bands('B04', 'B08')
+    arrays['B04'][0, :3] = 0
+    arrays['B08'][0, :3] = [0, 0.5, -0.5]
+    arrays['B04'][1, 0] = 0.5
+    arrays['B08'][1, 0] = -0.5
+    result = IndexKernel('ndvi', '(B08 - B04) / (B08 + B04)')(arrays)
+    assert np.isnan(result[0, 0])
+    assert result[0, 1] == 1 and result[0, 2] == 1
+    assert np.isnan(result[1, 0])
+    assert np.isfinite(result[2:]).all()
+
+
+def test_log_of_zero_is_nan(backend):
+    arrays = bands('B08')
+    arrays['B08'][0, 0] = 0
+    result = IndexKernel('logn', 'log(B08)')(arrays)
+    assert np.isnan(result[0, 0])
+    np.testing.assert_allclose(result[1:], np.log(arrays['B08'][1:]), rtol=1e-6)
+
+
+def test_builtin_indices_are_not_redefined():
+    pytest.importorskip('osgeo')
+    import raster_mod as rm
+    with pytest.raises(ValueError):
+        rm.register_indices({'ndvi': '(B08 - B04) / (B08 + B04 + 1)'})
+    assert rm.VI_EXPRESSIONS['ndvi'] == '(B08 - B04) / (B08 + B04)'
+    rm.register_indices({'evi2': '2.5 * (B08 - B04) / (B08 + 2.4 * B04 + 1)'})
+    assert rm.VI_BANDS['evi2'] == ['B04', 'B08']